@@ -0,0 +1,255 @@
+"""
+Benchmarks of the 'datafiles' setup for synthetic fixture trees of
+different shapes, every copy mode and the relevant 'on_duplicate' settings.
+A setup runs the same steps as the fixture: preparing the marked entries
+('_DatafilesState.prepare_all', including the 'pytest_datafiles_resolve'
+hook), planning the copy with the marker options ('_plan_marks') and
+executing the plan ('_execute_plan'). The marks are resolved once, like at
+the collection, and the session state (e.g. the private copies of the
+sources linked with copy_mode "hardlink") is kept between the setups.
+
+For every combination the median setup latency, the throughput and the peak
+memory allocated by Python are measured. The results can be saved as a
+baseline and later runs compared against it:
+
+    python benchmarks/bench_datafiles.py --save .benchmarks/baseline.json
+    python benchmarks/bench_datafiles.py --compare .benchmarks/baseline.json
+
+With '--compare' the exit status is 1 if any setup got slower than the
+baseline by more than '--tolerance'.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import pytest
+from _pytest.config import _prepareconfig
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pytest_datafiles import (  # noqa: E402
+    COPY_MODES,
+    _execute_plan,
+    _plan_marks,
+    _resolve_marks,
+)
+
+
+def _write(path: Path, size: int):
+    """Creates the file 'path' with 'size' pseudo random bytes."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as file:
+        chunk = os.urandom(min(size, 1024**2))
+        while size > 0:
+            file.write(chunk[:size])
+            size -= len(chunk)
+
+
+def _tiny_files(root: Path, scale: float):
+    """Many small files in a few directories."""
+    for i in range(int(5000 * scale) or 1):
+        _write(root / f"dir{i % 20}" / f"file{i}", 256)
+    return [root]
+
+
+def _huge_files(root: Path, scale: float):
+    """A few big files."""
+    for i in range(4):
+        _write(root / f"file{i}", int(64 * 1024**2 * scale) or 1)
+    return [root]
+
+
+def _deep_tree(root: Path, scale: float):
+    """Deeply nested directories with a file on every level."""
+    for branch in range(int(10 * scale) or 1):
+        path = root / f"branch{branch}"
+        for level in range(40):
+            path = path / f"level{level}"
+            _write(path / "file", 1024)
+    return [root]
+
+
+def _symlinks(root: Path, scale: float):
+    """Files with several symlinks pointing to each of them."""
+    for i in range(int(1000 * scale) or 1):
+        _write(root / f"file{i}", 1024)
+        for link in range(3):
+            os.symlink(f"file{i}", root / f"link{i}_{link}")
+    return [root]
+
+
+def _duplicates(root: Path, scale: float):
+    """Directories with mostly the same entries, marked together."""
+    sources = []
+    for copy in range(3):
+        source = root / f"copy{copy}"
+        for i in range(int(1000 * scale) or 1):
+            _write(source / f"dir{i % 10}" / f"file{i}", 1024)
+        sources.append(source)
+    return sources
+
+
+# shape -> (generator, 'on_duplicate' settings to measure); the trees without
+# duplicates behave the same with every setting
+SHAPES = {
+    "tiny_files": (_tiny_files, ["exception"]),
+    "huge_files": (_huge_files, ["exception"]),
+    "deep_tree": (_deep_tree, ["exception"]),
+    "symlinks": (_symlinks, ["exception"]),
+    "duplicates": (_duplicates, ["ignore", "overwrite"]),
+}
+
+
+def _tree_size(sources) -> int:
+    """Returns the total size of the regular files below 'sources'."""
+    size = 0
+    for source in sources:
+        for dirpath, _, filenames in os.walk(source):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if not os.path.islink(path):
+                    size += os.path.getsize(path)
+    return size
+
+
+class _Item:
+    """Minimal test item carrying a 'datafiles' mark for '_resolve_marks'."""
+
+    def __init__(self, *args, **kwargs):
+        self._mark = pytest.mark.datafiles(*args, **kwargs).mark
+
+    def iter_markers(self, name):
+        return [self._mark] if name == "datafiles" else []
+
+
+def _measure(config, sources, copy_mode, on_duplicate, work: Path, repeat: int):
+    """
+    Returns the results of 'repeat' setups of 'sources' below 'work'. The
+    peak memory is measured in a separate setup, tracing the allocations
+    would distort the timing.
+    """
+    state = config.pluginmanager.get_plugin("datafiles_state")
+    basetemp = work / "basetemp"
+    basetemp.mkdir(exist_ok=True)
+    item = _Item(*sources, copy_mode=copy_mode, on_duplicate=on_duplicate)
+    marks = _resolve_marks(item, config)
+
+    def setup():
+        target = work / "target"
+        target.mkdir()
+        start = time.perf_counter()
+        all_entries, mode = state.prepare_all(marks, basetemp)
+        plan = _plan_marks(all_entries, target, marks.options)
+        _execute_plan(plan, mode, state.workers, state.copy_function())
+        duration = time.perf_counter() - start
+        shutil.rmtree(target)
+        return duration
+
+    duration = statistics.median(setup() for _ in range(repeat))
+    tracemalloc.start()
+    setup()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    size = _tree_size(sources)
+    return {
+        "seconds": duration,
+        "bytes": size,
+        "mib_per_second": size / 1024**2 / duration if duration else 0.0,
+        "peak_memory": peak,
+    }
+
+
+def run(scale: float, repeat: int, shapes) -> dict:
+    """Runs the benchmarks of 'shapes' and returns the results by name."""
+    results = {}
+    # the plugin as configured by pytest, with the default options
+    config = _prepareconfig(["-p", "pytest_datafiles", "-p", "no:cacheprovider"])
+    config._do_configure()
+    with tempfile.TemporaryDirectory(prefix="datafiles-bench-") as tmp:
+        work = Path(tmp)
+        for shape in shapes:
+            generate, on_duplicates = SHAPES[shape]
+            sources = generate(work / "sources" / shape, scale)
+            for copy_mode in COPY_MODES:
+                for on_duplicate in on_duplicates:
+                    name = f"{shape}-{copy_mode}-{on_duplicate}"
+                    result = _measure(
+                        config, sources, copy_mode, on_duplicate, work, repeat
+                    )
+                    results[name] = result
+                    print(
+                        f"{name:<36} {result['seconds'] * 1000:10.2f} ms "
+                        f"{result['mib_per_second']:10.1f} MiB/s "
+                        f"{result['peak_memory'] / 1024:10.0f} KiB peak"
+                    )
+    config._ensure_unconfigure()
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Returns the names of the results slower than 'baseline' allows."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["seconds"] / baseline[name]["seconds"]
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            print(f"REGRESSION {name}: {ratio:.2f}x the baseline")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Factor applied to the number and size of the generated files.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Setups per combination (median)."
+    )
+    parser.add_argument(
+        "--shape", action="append", choices=sorted(SHAPES), help="Shapes to run."
+    )
+    parser.add_argument("--save", metavar="PATH", help="Save the results as JSON.")
+    parser.add_argument(
+        "--compare", metavar="PATH", help="Compare to the results saved in PATH."
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed slowdown compared to the baseline (default 0.25).",
+    )
+    args = parser.parse_args(argv)
+
+    results = run(args.scale, args.repeat, args.shape or list(SHAPES))
+    if args.save:
+        path = Path(args.save)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        info = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "scale": args.scale,
+        }
+        path.write_text(json.dumps({"info": info, "results": results}, indent=2))
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())["results"]
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,12 +2,307 @@
 Module containing a 'datafiles' fixture for pytest Tests.
 """
 
+import errno
+import fnmatch
+import hashlib
+import importlib
+import json
+import mmap
+import os
+import re
 import shutil
+import stat
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import types
+import zipfile
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import List
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
 
 import pytest
 from _pytest.config import Config
+from _pytest.config.argparsing import Parser
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (Windows)
+    fcntl = None
+    import msvcrt
+
+# ioctl request number of FICLONE (_IOW(0x94, 9, int)) from linux/fs.h
+_FICLONE = 0x40049409
+
+COPY_MODES = ("copy", "reflink", "hardlink", "none")
+
+_WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+# archive suffixes understood with extract=True and their format
+_ARCHIVE_FORMATS = {
+    ".tar": "tar",
+    ".tar.gz": "tar",
+    ".tgz": "tar",
+    ".tar.bz2": "tar",
+    ".tbz2": "tar",
+    ".tar.xz": "tar",
+    ".txz": "tar",
+    ".tar.zst": "tar.zst",
+    ".tzst": "tar.zst",
+    ".zip": "zip",
+}
+
+# suffixes of compressed files understood with decompress=True and the
+# module to decompress them with
+_COMPRESSION_FORMATS = {
+    ".gz": "gzip",
+    ".bz2": "bz2",
+    ".xz": "lzma",
+    ".lzma": "lzma",
+    ".zst": "zstd",
+}
+
+# fixtures copying the files of the 'datafiles' marks
+_FIXTURE_NAMES = {"datafiles", "datafiles_module", "datafiles_session"}
+
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+# tmpfs for location="ram" and the size of its pages
+_RAM_DIR = "/dev/shm"
+_RAM_PAGE_SIZE = 4096
+
+LOCATIONS = ("tmp", "ram")
+
+# datafiles kept after the tests: of all tests, only of failed tests or none
+RETAIN_POLICIES = ("all", "failed", "none")
+
+# statistics of a materialization that add up over a test session
+_REPORT_TOTALS = ("duration", "files", "dirs", "symlinks", "bytes", "allocated")
+
+
+def pytest_addoption(parser: Parser) -> None:
+    """Register command line and ini options."""
+    parser.addini(
+        "datafiles_copy_mode",
+        "Default 'copy_mode' of the datafiles marker (copy, reflink, hardlink or "
+        "none).",
+        default="copy",
+    )
+    parser.addini(
+        "datafiles_cache_size",
+        "Byte budget (e.g. 512M, 2G) of the session cache holding a snapshot "
+        "of every marked source. 0 disables the cache.",
+        default="0",
+    )
+    parser.addini(
+        "datafiles_workers",
+        "Number of threads used to copy the files of the datafiles (default 1).",
+        default="1",
+    )
+    parser.addini(
+        "datafiles_persist_size",
+        "Size limit (e.g. 512M, 2G) of the store in pytest's cache directory "
+        "that keeps prepared sources (e.g. extracted archives) between runs. "
+        "0 disables the store.",
+        default="0",
+    )
+    parser.addini(
+        "datafiles_prefetch",
+        "Copy the datafiles of the next test in the background while the "
+        "current test runs.",
+        type="bool",
+        default=False,
+    )
+    parser.addini(
+        "datafiles_group",
+        "Run tests with the same datafiles marks one after the other and reuse "
+        "the datafiles of the previous test if it didn't change them.",
+        type="bool",
+        default=False,
+    )
+    parser.addini(
+        "datafiles_basetemp_ram",
+        "Default 'location' of the datafiles marker: 'ram' if true, 'tmp' otherwise.",
+        type="bool",
+        default=False,
+    )
+    parser.addini(
+        "datafiles_ram_size",
+        "Size limit (e.g. 512M, 2G) of all datafiles in RAM at the same time "
+        "(location='ram'), datafiles that don't fit are copied to tmp_path.",
+        default="512M",
+    )
+    parser.addini(
+        "datafiles_retain",
+        "Which datafiles to keep after the tests: 'all' (default), 'failed' "
+        "(only those of failed tests) or 'none'.",
+        default="all",
+    )
+    parser.addini(
+        "datafiles_user_properties",
+        "Also record the statistics of the datafiles setups in the tests' "
+        "user_properties (and hence in the JUnit XML).",
+        type="bool",
+        default=False,
+    )
+    group = parser.getgroup("datafiles")
+    group.addoption(
+        "--datafiles-cache-size",
+        dest="datafiles_cache_size",
+        default=None,
+        help="Byte budget (e.g. 512M, 2G) of the session cache holding a "
+        "snapshot of every marked source, overrides the 'datafiles_cache_size' "
+        "ini option. 0 disables the cache.",
+    )
+    group.addoption(
+        "--datafiles-workers",
+        dest="datafiles_workers",
+        default=None,
+        help="Number of threads used to copy the files of the datafiles, "
+        "overrides the 'datafiles_workers' ini option.",
+    )
+    group.addoption(
+        "--datafiles-persist-size",
+        dest="datafiles_persist_size",
+        default=None,
+        help="Size limit (e.g. 512M, 2G) of the store in pytest's cache "
+        "directory that keeps prepared sources (e.g. extracted archives) "
+        "between runs, overrides the 'datafiles_persist_size' ini option. 0 "
+        "disables the store.",
+    )
+    group.addoption(
+        "--datafiles-cache-clear",
+        action="store_true",
+        dest="datafiles_cache_clear",
+        help="Remove the datafiles store from pytest's cache directory at the "
+        "start of the run.",
+    )
+    group.addoption(
+        "--datafiles-prefetch",
+        action="store_true",
+        dest="datafiles_prefetch",
+        default=None,
+        help="Copy the datafiles of the next test in the background while the "
+        "current test runs, overrides the 'datafiles_prefetch' ini option.",
+    )
+    group.addoption(
+        "--datafiles-group",
+        action="store_true",
+        dest="datafiles_group",
+        default=None,
+        help="Run tests with the same datafiles marks one after the other and "
+        "reuse the datafiles of the previous test if it didn't change them, "
+        "overrides the 'datafiles_group' ini option.",
+    )
+    group.addoption(
+        "--datafiles-basetemp-ram",
+        action="store_true",
+        dest="datafiles_basetemp_ram",
+        default=None,
+        help="Copy datafiles to RAM (location='ram') unless the marker says "
+        "otherwise, overrides the 'datafiles_basetemp_ram' ini option.",
+    )
+    group.addoption(
+        "--datafiles-ram-size",
+        dest="datafiles_ram_size",
+        default=None,
+        help="Size limit (e.g. 512M, 2G) of all datafiles in RAM at the same "
+        "time, overrides the 'datafiles_ram_size' ini option.",
+    )
+    group.addoption(
+        "--datafiles-retain",
+        choices=RETAIN_POLICIES,
+        dest="datafiles_retain",
+        default=None,
+        help="Which datafiles to keep after the tests: 'all', 'failed' (only "
+        "those of failed tests) or 'none', overrides the 'datafiles_retain' "
+        "ini option. The others are removed in the background right after "
+        "the test.",
+    )
+    group.addoption(
+        "--datafiles-report",
+        type=int,
+        metavar="N",
+        dest="datafiles_report",
+        default=None,
+        help="Show the N slowest and the N largest datafiles setups at the end "
+        "of the run (N=0 for all).",
+    )
+    group.addoption(
+        "--datafiles-report-json",
+        metavar="PATH",
+        dest="datafiles_report_json",
+        default=None,
+        help="Write the statistics of all datafiles setups as JSON to PATH.",
+    )
+    group.addoption(
+        "--datafiles-user-properties",
+        action="store_true",
+        dest="datafiles_user_properties",
+        default=None,
+        help="Also record the statistics of the datafiles setups in the tests' "
+        "user_properties (and hence in the JUnit XML), overrides the "
+        "'datafiles_user_properties' ini option.",
+    )
+
+
+class _HookSpecs:
+    """
+    Hooks of the datafiles plugin. They can be implemented in conftest.py
+    files or plugins to trace or replace parts of the materialization.
+    """
+
+    @pytest.hookspec(firstresult=True)
+    def pytest_datafiles_resolve(self, entries, options):
+        """
+        Return the list of entries (paths of files and directories) to copy
+        into the datafiles directory for the marked 'entries' and the
+        validated marker 'options'. Called for every setup, after the
+        entries were replaced by snapshots, extracted archives or the output
+        of generated entries. The default implementation evaluates
+        'keep_top_dir'.
+        """
+
+    @pytest.hookspec(firstresult=True)
+    def pytest_datafiles_copy(self, source, target, copy_mode, copy_metadata):
+        """
+        Copy the file 'source' to 'target' (which doesn't exist) and return
+        the name of the strategy that was used, or None to leave the copy to
+        the next implementation. 'copy_mode' is the 'copy_mode' of the marks,
+        'copy_metadata' (e.g. 'shutil.copystat') should be called with
+        'source' and 'target' unless 'target' is a link. Implementations may
+        be called concurrently from several threads.
+        """
+
+    @pytest.hookspec
+    def pytest_datafiles_materialized(self, path, stats, node):
+        """
+        Called after the datafiles directory 'path' of the test item 'node'
+        was set up, 'stats' is the statistics dictionary recorded for the
+        test (see 'datafiles_stats'). With 'lazy=True' files are only copied
+        when they are accessed, 'stats' is completed when the test is torn
+        down.
+        """
+
+
+def pytest_addhooks(pluginmanager) -> None:
+    """Register the hooks of the plugin."""
+    pluginmanager.add_hookspecs(_HookSpecs)
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_datafiles_resolve(entries, options):
+    """Default implementation: evaluate 'keep_top_dir'."""
+    return _get_all_entries(entries, options["keep_top_dir"])
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_datafiles_copy(source, target, copy_mode, copy_metadata):
+    """Default implementation: copy according to 'copy_mode'."""
+    return _copy_file(source, target, copy_mode, copy_metadata)
 
 
 def pytest_configure(config: Config) -> None:
@@ -15,33 +310,1941 @@ def pytest_configure(config: Config) -> None:
     config.addinivalue_line(
         "markers",
         "datafiles(path, ..., *, keep_top_dir=False, "
-        "on_duplicate='exception'): Paths to copy to tmpdir before the test. "
+        "on_duplicate='exception', copy_mode='copy', lazy=False, extract=False, "
+        "include=None, exclude=None, preserve_metadata=True, location='tmp', "
+        "detect_mutation=False, decompress=False): "
+        "Paths to copy to tmpdir before the test. "
         "'keep_top_dir': For all parameters that represent directories, keep "
         "that directory instead of only (recursively) copying its content "
         "(default is False). Use the option 'on_duplicate' to specify the "
         "action to take when duplicate files/directories are found. Possible "
-        "values are: exception, ignore and replace. The default value is "
-        "exception.",
+        "values are: exception, ignore and overwrite. The default value is "
+        "exception. 'copy_mode': How files are copied, either 'copy' (a "
+        "regular copy), 'reflink' (a copy-on-write clone if the filesystem "
+        "supports it, a regular copy otherwise), 'hardlink' (read-only hard "
+        "links to private copies of the files if possible, a regular copy "
+        "otherwise) or 'none' (symlinks to the original files, nothing is "
+        "copied). "
+        "The default is taken from the 'datafiles_copy_mode' ini option. "
+        "'lazy': Only create the directories up front and copy each file the "
+        "first time it is accessed (default is False). 'extract': Extract "
+        "archives (.tar, .tar.gz, .tar.bz2, .tar.xz, .tar.zst, .zip) and use "
+        "them like a directory named after the archive (default is False). "
+        "'include'/'exclude': Glob patterns (matched against the name, or the "
+        "path relative to tmpdir if they contain a '/'), callables (called with "
+        "the source path) or lists of them selecting the entries to copy. "
+        "Excluded directories are not walked. 'preserve_metadata': Copy the "
+        "permissions and times of the entries, not only the content of the "
+        "files (default is True). 'location': 'tmp' to copy to tmp_path or "
+        "'ram' to copy to a directory in RAM (tmpfs), if the size limit "
+        "'datafiles_ram_size' allows it (default is 'tmp' unless changed with "
+        "the 'datafiles_basetemp_ram' ini option). 'detect_mutation': Fail "
+        "the test if it modified the source files or directories (default is "
+        "False). 'decompress': Decompress marked files (.gz, .bz2, .xz, .lzma, "
+        ".zst) and use them without the suffix (default is False).",
+    )
+    config.pluginmanager.register(_DatafilesState(config), "datafiles_state")
+
+
+def pytest_unconfigure(config: Config) -> None:
+    """Drop the session state."""
+    state = config.pluginmanager.get_plugin("datafiles_state")
+    if state is not None:
+        config.pluginmanager.unregister(state)
+
+
+def _get_option(config: Config, name: str):
+    """
+    Returns the value of the command line option 'name' or, if it wasn't
+    given, of the ini option with the same name.
+    """
+    value = config.getoption(name)
+    if value is None:
+        value = config.getini(name)
+    return value
+
+
+def _parse_size(value) -> int:
+    """
+    Converts a size like '512M' or '2G' (powers of 1024) to a number of bytes.
+    """
+    text = str(value).strip().upper().rstrip("B")
+    unit = text[-1:] if text[-1:] in _SIZE_UNITS else ""
+    try:
+        size = float(text[: len(text) - len(unit)]) * _SIZE_UNITS[unit]
+    except ValueError:
+        raise ValueError(f"Invalid size '{value}'") from None
+    if not 0 <= size < float("inf"):
+        raise ValueError(f"Invalid size '{value}'")
+    return int(size)
+
+
+def _get_size_option(config: Config, name: str) -> int:
+    """
+    Returns the size option 'name' (see '_get_option') as a number of bytes.
+    """
+    value = _get_option(config, name)
+    try:
+        return _parse_size(value)
+    except ValueError:
+        raise pytest.UsageError(
+            f"{name.replace('_', ' ')} must be a size like 512M or 2G, got '{value}'"
+        ) from None
+
+
+def _format_size(size: int) -> str:
+    """Converts a number of bytes to a human readable size like '1.5 MiB'."""
+    units = ["B", "KiB", "MiB", "GiB", "TiB"]
+    while size >= 1024 and len(units) > 1:
+        size /= 1024
+        units.pop(0)
+    return f"{size:.0f} B" if units[0] == "B" else f"{size:.1f} {units[0]}"
+
+
+def _fingerprint(source: Path) -> Tuple[str, int]:
+    """
+    Returns a fingerprint of 'source' (a file or directory) built from the
+    path, modification time and size of all the entries it contains, together
+    with the total size in bytes. Only metadata is read, not the content.
+    """
+    digest = hashlib.sha1(str(source.absolute()).encode())
+    size = 0
+    if source.is_dir() and not source.is_symlink():
+        for dirpath, dirnames, filenames in os.walk(source):
+            dirnames.sort()
+            for name in sorted(filenames) + dirnames:
+                path = os.path.join(dirpath, name)
+                entry_stat = os.lstat(path)
+                if stat.S_ISREG(entry_stat.st_mode):
+                    size += entry_stat.st_size
+                digest.update(
+                    f"{os.path.relpath(path, source)}\0{entry_stat.st_mtime_ns}"
+                    f"\0{entry_stat.st_size}\0{entry_stat.st_mode}\0".encode()
+                )
+    else:
+        source_stat = source.lstat()
+        size = source_stat.st_size
+        digest.update(
+            f"{source_stat.st_mtime_ns}\0{size}\0{source_stat.st_mode}".encode()
+        )
+    return digest.hexdigest(), size
+
+
+class _SnapshotCache:
+    """
+    Session wide cache holding a pristine copy ("snapshot") of marked sources.
+
+    Snapshots are keyed by a fingerprint of the source (see '_fingerprint'), so
+    a source that is modified during the session gets a new snapshot. The total
+    size of all snapshots is limited to 'max_bytes', the least recently used
+    ones are evicted first. Sources bigger than the budget are not cached.
+    Pinned snapshots (see 'pin') are never evicted.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._snapshots = OrderedDict()  # fingerprint -> (path, size)
+        self._pinned = Counter()  # fingerprint -> number of pins
+
+    def get(self, sources: List[Path], root: Path) -> List[Path]:
+        """
+        Returns the snapshots of all 'sources', creating them below 'root' if
+        necessary. A source that doesn't fit in the cache (without evicting
+        the snapshots of the other 'sources') is returned unchanged.
+        """
+        result = []
+        used = set()
+        for source in sources:
+            key, size = _fingerprint(source)
+            used.add(key)
+            if key in self._snapshots:
+                self._snapshots.move_to_end(key)
+                result.append(self._snapshots[key][0])
+            elif self._make_room(size, used):
+                snapshot = root / key / source.name
+                snapshot.parent.mkdir(parents=True)
+                _snapshot(source, snapshot)
+                self._snapshots[key] = (snapshot, size)
+                self.size += size
+                result.append(snapshot)
+            else:
+                result.append(source)
+        return result
+
+    def pin(self, snapshots: List[Path]) -> List[str]:
+        """
+        Protects the 'snapshots' (paths returned by 'get') from being
+        evicted, e.g. while a shared tree restores files from them. Returns
+        the keys to pass to 'unpin'.
+        """
+        keys = {path: key for key, (path, _) in self._snapshots.items()}
+        pinned = [keys[snapshot] for snapshot in snapshots if snapshot in keys]
+        self._pinned.update(pinned)
+        return pinned
+
+    def unpin(self, keys: List[str]):
+        """Allows evicting the snapshots pinned with 'keys' again."""
+        self._pinned.subtract(keys)
+
+    def _make_room(self, size: int, used: set) -> bool:
+        """
+        Evicts the least recently used snapshots (except the ones in 'used'
+        and the pinned ones) until 'size' bytes fit into the budget. Returns
+        False if that's not possible.
+        """
+        evictable = [
+            key for key in self._snapshots if key not in used and self._pinned[key] <= 0
+        ]
+        freeable = sum(self._snapshots[key][1] for key in evictable)
+        if self.size - freeable + size > self.max_bytes:
+            return False
+        for key in evictable:
+            if self.size + size <= self.max_bytes:
+                break
+            snapshot, snapshot_size = self._snapshots.pop(key)
+            shutil.rmtree(snapshot.parent, ignore_errors=True)
+            self.size -= snapshot_size
+        return True
+
+
+class _SharedSnapshots:
+    """
+    Snapshot store shared by all pytest-xdist workers of a run (used instead
+    of '_SnapshotCache' in the workers): the first worker that needs a source
+    creates its snapshot, guarded by a file lock, the others wait for it and
+    copy from it. Snapshots are not evicted because other workers might be
+    copying from them; sources bigger than 'max_bytes' are not cached. The
+    store is removed by the controller at the end of the run.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._snapshots: Dict[str, Path] = {}  # fingerprint -> path
+
+    def pin(self, snapshots: List[Path]) -> List[str]:
+        """Shared snapshots are never evicted, pinning isn't necessary."""
+        return []
+
+    def unpin(self, keys: List[str]):
+        """See 'pin'."""
+
+    def get(self, sources: List[Path], root: Path) -> List[Path]:
+        """
+        Returns the snapshots of all 'sources', creating them below 'root' if
+        no worker did yet.
+        """
+        result = []
+        for source in sources:
+            key, size = _fingerprint(source)
+            if size > self.max_bytes:
+                result.append(source)
+                continue
+            if key not in self._snapshots:
+                root.mkdir(parents=True, exist_ok=True)
+                with _FileLock(root / f"{key}.lock"):
+                    if not (root / key).is_dir():
+                        staging = Path(tempfile.mkdtemp(prefix=".staging-", dir=root))
+                        _snapshot(source, staging / source.name)
+                        os.rename(staging, root / key)
+                self._snapshots[key] = root / key / source.name
+            result.append(self._snapshots[key])
+        return result
+
+
+class _FileLock:
+    """
+    Exclusive lock on the file 'path' (created if necessary) between
+    processes, used as a context manager.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, "a+b")
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        else:  # pragma: no cover (Windows)
+            self._file.seek(0)
+            while True:
+                try:  # LK_LOCK gives up after 10 seconds
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        return self
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:  # pragma: no cover (Windows)
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+
+
+def _snapshot(source: Path, snapshot: Path):
+    """
+    Copies the file or directory 'source' with its metadata to 'snapshot',
+    preserving the holes of sparse files.
+    """
+    if source.is_dir():
+        shutil.copytree(source, snapshot, symlinks=True, copy_function=_copy2)
+    elif source.is_symlink():
+        shutil.copy2(source, snapshot, follow_symlinks=False)
+    else:
+        _copy2(source, snapshot)
+
+
+def _copy2(src, dst):
+    """Like 'shutil.copy2', but copies the content with '_copy_content'."""
+    _copy_content(src, dst)
+    shutil.copystat(src, dst)
+
+
+def _archive_suffix(path: Path) -> Optional[str]:
+    """
+    Returns the archive suffix (see '_ARCHIVE_FORMATS') of 'path' or None if
+    it's not an archive.
+    """
+    name = path.name.lower()
+    for suffix in sorted(_ARCHIVE_FORMATS, key=len, reverse=True):
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return suffix
+    return None
+
+
+def _open_zstd(path: Path):
+    """
+    Returns a (streaming) file object with the decompressed content of the
+    zstd compressed file 'path'.
+    """
+    try:
+        from compression import zstd  # Python >= 3.14
+
+        return zstd.open(path, "rb")
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            f"Decompressing '{path}' requires the 'zstandard' package "
+            "(pip install pytest-datafiles[zstd])"
+        ) from None
+    return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+
+
+def _extract_archive(archive: Path, target: Path):
+    """
+    Extracts 'archive' into the directory 'target'. Tar archives are read as
+    a stream, members that would end up outside of 'target' (or links
+    pointing outside of it) and special files are rejected with the "data"
+    extraction filter or, on Python versions without extraction filters, by
+    '_check_tar_member'. Zip archives can't contain such members.
+    """
+    archive_format = _ARCHIVE_FORMATS[_archive_suffix(archive)]
+    if archive_format == "zip":
+        with zipfile.ZipFile(archive) as zip_file:
+            zip_file.extractall(target)
+        return
+    if archive_format == "tar.zst":
+        stream, mode = _open_zstd(archive), "r|"
+    else:
+        stream, mode = open(archive, "rb"), "r|*"
+    with stream, tarfile.open(fileobj=stream, mode=mode) as tar:
+        if hasattr(tarfile, "data_filter"):
+            tar.extractall(target, filter="data")
+            return
+        for member in tar:
+            _check_tar_member(archive, member, target)
+            tar.extract(member, target)
+
+
+def _check_tar_member(archive: Path, member: tarfile.TarInfo, target: Path):
+    """
+    Raises ValueError if extracting the tar 'member' of 'archive' into
+    'target' would create a special file or write (or link) outside of
+    'target', also through a symlink extracted before.
+    """
+    root = os.path.realpath(target)
+
+    def inside(path: str) -> bool:
+        return os.path.commonpath([root, os.path.realpath(path)]) == root
+
+    destination = os.path.join(root, member.name)
+    if not (member.isfile() or member.isdir() or member.issym() or member.islnk()):
+        problem = "is a special file"
+    elif os.path.isabs(member.name) or not inside(destination):
+        problem = "would be extracted outside of the target directory"
+    elif member.issym() and not inside(
+        os.path.join(os.path.dirname(destination), member.linkname)
+    ):
+        problem = "links outside of the target directory"
+    elif member.islnk() and not inside(os.path.join(root, member.linkname)):
+        problem = "links outside of the target directory"
+    else:
+        return
+    raise ValueError(f"Member '{member.name}' of '{archive}' {problem}")
+
+
+def _compression_suffix(path: Path) -> Optional[str]:
+    """
+    Returns the compression suffix (see '_COMPRESSION_FORMATS') of 'path' or
+    None if it's not compressed.
+    """
+    name = path.name.lower()
+    suffix = os.path.splitext(name)[1]
+    if suffix in _COMPRESSION_FORMATS and len(name) > len(suffix):
+        return suffix
+    return None
+
+
+def _decompress_file(source: Path, target: Path):
+    """
+    Decompresses the file 'source' as a stream into the file 'target' and
+    copies the permissions and times of 'source'.
+    """
+    module = _COMPRESSION_FORMATS[_compression_suffix(source)]
+    if module == "zstd":
+        stream = _open_zstd(source)
+    else:
+        stream = importlib.import_module(module).open(source, "rb")
+    with stream, open(target, "wb") as output:
+        shutil.copyfileobj(stream, output, 1024 * 1024)
+    shutil.copystat(source, target)
+
+
+def _content_hash(path: Path) -> str:
+    """Returns the SHA-256 hash of the content of the file 'path'."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _cache_dir(cache) -> Path:
+    """
+    Returns the directory of the persistent store in pytest's cache
+    ('Cache.mkdir' was added in pytest 7.0, 'Cache.makedir' is used before).
+    """
+    if hasattr(cache, "mkdir"):
+        return Path(cache.mkdir("datafiles"))
+    return Path(str(cache.makedir("datafiles")))
+
+
+class _PersistentStore:
+    """
+    Store in pytest's cache directory ('.pytest_cache/d/datafiles') keeping
+    prepared sources (e.g. extracted archives) between runs.
+
+    Entries are keyed by the content hash of their sources. The hashes
+    themselves are remembered per fingerprint (see '_fingerprint') so that
+    unmodified sources aren't read again. At the end of the session the least
+    recently used entries are removed until the store fits into 'max_bytes'.
+    pytest-xdist workers share the store: they only merge their usage into
+    the index, the controller prunes the store once all of them finished.
+    """
+
+    INDEX_KEY = "datafiles/index"
+
+    def __init__(self, cache, max_bytes: int):
+        self._cache = cache
+        self.max_bytes = max_bytes
+        self.root = _cache_dir(cache)
+        index = cache.get(self.INDEX_KEY, {})
+        self._entries: Dict[str, dict] = {}  # key -> {"size": .., "used": ..}
+        for path in self.root.iterdir():
+            if path.is_dir() and not path.name.startswith("."):
+                self._entries[path.name] = index.get("entries", {}).get(
+                    path.name, {"size": _fingerprint(path)[1], "used": 0}
+                )
+        self._hashes: Dict[str, str] = index.get("hashes", {})
+
+    @staticmethod
+    def clear(cache):
+        """Removes the store from pytest's cache directory."""
+        shutil.rmtree(_cache_dir(cache), ignore_errors=True)
+        cache.set(_PersistentStore.INDEX_KEY, {})
+
+    def content_hash(self, source: Path) -> str:
+        """Returns the content hash of the file 'source'."""
+        fingerprint, _ = _fingerprint(source)
+        if fingerprint not in self._hashes:
+            self._hashes[fingerprint] = _content_hash(source)
+        return self._hashes[fingerprint]
+
+    def get(self, key: str, name: str, create) -> Path:
+        """
+        Returns the directory 'name' of the entry 'key', calling
+        'create(directory)' to fill it if the entry doesn't exist yet.
+        """
+        entry = self.root / key
+        if not entry.is_dir():
+            staging = Path(tempfile.mkdtemp(prefix=".staging-", dir=self.root))
+            try:
+                (staging / name).mkdir()
+                create(staging / name)
+                os.rename(staging, entry)
+            except OSError:
+                if not entry.is_dir():
+                    raise
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+            self._entries[key] = {"size": _fingerprint(entry)[1]}
+        elif key not in self._entries:  # created by another pytest-xdist worker
+            self._entries[key] = {"size": _fingerprint(entry)[1]}
+        self._entries[key]["used"] = time.time()
+        return entry / name
+
+    def save(self, prune: bool = True):
+        """
+        Merges the usage of the entries into the saved index and, if 'prune'
+        is true, removes the least recently used entries until the store fits
+        into 'max_bytes'. Guarded by a file lock, since pytest-xdist workers
+        save the store concurrently.
+        """
+        with _FileLock(self.root.parent / "datafiles.lock"):
+            index = self._cache.get(self.INDEX_KEY, {})
+            entries = {}
+            for path in self.root.iterdir():
+                if path.is_dir() and not path.name.startswith("."):
+                    entries[path.name] = index.get("entries", {}).get(
+                        path.name, {"size": _fingerprint(path)[1], "used": 0}
+                    )
+            for key, entry in self._entries.items():
+                if key in entries and entry["used"] >= entries[key]["used"]:
+                    entries[key] = entry
+            if prune:
+                size = sum(entry["size"] for entry in entries.values())
+                for key in sorted(entries, key=lambda k: entries[k]["used"]):
+                    if size <= self.max_bytes:
+                        break
+                    shutil.rmtree(self.root / key, ignore_errors=True)
+                    size -= entries.pop(key)["size"]
+            hashes = {
+                fingerprint: content_hash
+                for fingerprint, content_hash in {
+                    **index.get("hashes", {}),
+                    **self._hashes,
+                }.items()
+                if any(key.endswith(content_hash) for key in entries)
+            }
+            self._cache.set(self.INDEX_KEY, {"entries": entries, "hashes": hashes})
+
+
+class _Generated(NamedTuple):
+    """
+    Marked entry produced by a factory, see 'generated'. 'cache_key'
+    identifies the output: it's derived from the name, the factory (its
+    qualified name and code) and 'key'.
+    """
+
+    name: str
+    factory: Callable[[Path], Any]
+    key: Any
+    cache_key: str
+
+    def __str__(self):
+        return f"<generated {self.name} {self.cache_key}>"
+
+
+def generated(name: str, factory: Callable[[Path], Any], key: Any = None):
+    """
+    Returns an entry for the 'datafiles' marker that is produced by
+    'factory': it's called with an empty directory 'name' and fills it (e.g.
+    with synthetic datasets). The output is generated once per session (once
+    per run with pytest-xdist, or once for all runs with the persistent
+    store) and used like a marked directory 'name'. 'key' (e.g. the
+    parameters of the factory) is part of the identity of the output, change
+    it to generate the output again.
+    """
+    if not name or os.sep in name or (os.altsep and os.altsep in name):
+        raise ValueError(
+            f"the name of generated datafiles must be a plain name, got '{name}'"
+        )
+    code = getattr(factory, "__code__", None)
+    identity = [
+        name,
+        getattr(factory, "__module__", ""),
+        getattr(factory, "__qualname__", repr(type(factory))),
+        repr(key),
+    ]
+    if code is not None:
+        identity.append(_code_identity(code))
+    digest = hashlib.sha256("\0".join(identity).encode()).hexdigest()[:16]
+    return _Generated(name, factory, key, f"{name}-{digest}")
+
+
+def _code_identity(value) -> str:
+    """
+    Returns a representation of the code object (or constant) 'value' that
+    is the same in every process: nested code objects (lambdas, inner
+    functions, comprehensions) are represented by their content instead of
+    their 'repr', which contains their address, and sets are sorted since
+    their order depends on the hash seed.
+    """
+    if isinstance(value, types.CodeType):
+        consts = ",".join(_code_identity(const) for const in value.co_consts)
+        return f"code({value.co_code.hex()};{','.join(value.co_names)};{consts})"
+    if isinstance(value, tuple):
+        return f"({','.join(_code_identity(item) for item in value)})"
+    if isinstance(value, frozenset):
+        return f"{{{','.join(sorted(_code_identity(item) for item in value))}}}"
+    return repr(value)
+
+
+def datafiles_stats(node) -> List[dict]:
+    """
+    Returns the statistics of the datafiles setups of the running test item
+    'node' (e.g. 'request.node'), one dictionary per datafiles fixture (see
+    the README for their keys). After the test they are attached to its
+    teardown report as 'datafiles'.
+    """
+    state = node.config.pluginmanager.get_plugin("datafiles_state")
+    return state.stats.get(node.nodeid, [])
+
+
+def datafiles_parametrize(
+    directory, pattern: str = "*", companions=(), argname: str = "datafile", **options
+):
+    """
+    Returns a decorator parametrizing a test over the files in 'directory'
+    matching the glob 'pattern' (e.g. '**/*.bin'). Every test item gets its
+    own 'datafiles' mark with only its file and the 'companions' (paths
+    relative to 'directory' or absolute), so every setup copies one file
+    instead of the whole directory. The marker 'options' apply to all items.
+    The argument 'argname' of the test is the name of the file in the
+    datafiles directory.
+    """
+    directory = Path(directory)
+    companions = [directory / companion for companion in companions]
+    files = sorted(
+        path
+        for path in directory.glob(pattern)
+        if path.is_file() and path not in companions
+    )
+    return pytest.mark.parametrize(
+        argname,
+        [
+            pytest.param(
+                path.name,
+                marks=pytest.mark.datafiles(path, *companions, **options),
+                id=path.relative_to(directory).as_posix(),
+            )
+            for path in files
+        ],
     )
 
 
-def _copy_all(entry_list: List[Path], target_dir: Path, on_duplicate: str):
+class _DatafilesState:
+    """
+    Session state of the plugin, registered as the plugin 'datafiles_state'.
+    """
+
+    def __init__(self, config: Config):
+        self._config = config
+        cache_size = _get_size_option(config, "datafiles_cache_size")
+        # pytest-xdist workers share the snapshots (see '_SharedSnapshots')
+        self.xdist_worker = hasattr(config, "workerinput")
+        self.snapshots = None
+        if cache_size:
+            cache_class = _SharedSnapshots if self.xdist_worker else _SnapshotCache
+            self.snapshots = cache_class(cache_size)
+        # copy_mode "hardlink" links to private copies of the sources only,
+        # because the write permission bits of the linked files are removed
+        link_sources_class = _SharedSnapshots if self.xdist_worker else _SnapshotCache
+        self.link_sources = link_sources_class(sys.maxsize)
+        workers = _get_option(config, "datafiles_workers")
+        try:
+            self.workers = int(workers)
+        except ValueError:
+            self.workers = 0
+        if self.workers < 1:
+            raise pytest.UsageError(
+                f"datafiles workers must be a positive number, got '{workers}'"
+            )
+        self._extracted: Dict[str, Path] = {}  # fingerprint -> directory
+        self._generated: Dict[str, Path] = {}  # cache key -> directory
+        self._decompressed: Dict[str, Path] = {}  # fingerprint -> file
+        self.marks: Dict[str, _Marks] = {}  # node id -> resolved marks
+        self.invalid: Dict[str, Exception] = {}  # node id -> error of the marks
+        cache = getattr(config, "cache", None)  # None without cacheprovider
+        if cache is not None and config.getoption("datafiles_cache_clear"):
+            _PersistentStore.clear(cache)
+        persist_size = _get_size_option(config, "datafiles_persist_size")
+        self.persistent: Optional[_PersistentStore] = (
+            _PersistentStore(cache, persist_size)
+            if cache is not None and persist_size
+            else None
+        )
+        self.report_count: Optional[int] = config.getoption("datafiles_report")
+        if self.report_count is not None and self.report_count < 0:
+            raise pytest.UsageError(
+                f"datafiles report must be a positive number or 0, "
+                f"got '{self.report_count}'"
+            )
+        self.report_json: Optional[str] = config.getoption("datafiles_report_json")
+        self.reports: List[Tuple[str, dict]] = []  # (node id, statistics)
+        # node id -> statistics of the datafiles setups of the running test
+        self.stats: Dict[str, List[dict]] = {}
+        self.user_properties = bool(_get_option(config, "datafiles_user_properties"))
+        self.hook = config.hook
+        self.prefetch = bool(_get_option(config, "datafiles_prefetch"))
+        # node id -> (staging directory, future of the '_prefetch' call)
+        self._prefetched: Dict[str, Tuple[Path, Future]] = {}
+        self._prefetcher: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()  # prepare_all() is used by the prefetcher
+        self.group = bool(_get_option(config, "datafiles_group"))
+        # node ids of the tests followed by a test with the same marks
+        self.reusable: Set[str] = set()
+        self._nextitem = None  # of the test being torn down
+        # (node id, root, plan, copy mode) of the datafiles for the next test
+        self._handoff: Optional[Tuple[str, Path, _CopyPlan, str]] = None
+        self.ram_size = _get_size_option(config, "datafiles_ram_size")
+        self._ram_root: Optional[Path] = None
+        # directory -> reserved bytes, shared by pytest-xdist workers in a file
+        self._ram_used: Dict[str, int] = {}
+        self.retain = _get_option(config, "datafiles_retain")
+        if self.retain not in RETAIN_POLICIES:
+            raise pytest.UsageError(
+                f"datafiles retain must be one of {', '.join(RETAIN_POLICIES)}, "
+                f"got '{self.retain}'"
+            )
+        self._failed: Set[str] = set()  # node ids of failed tests
+        # '_remove_tree' calls run one after the other by the remover, the
+        # directories are cleared by the deleter's threads
+        self._remover: Optional[ThreadPoolExecutor] = None
+        self._deleter: Optional[ThreadPoolExecutor] = None
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_runtest_protocol(self, item, nextitem):
+        """
+        With prefetching enabled, starts copying the datafiles of 'nextitem'
+        into a staging directory in the background while 'item' runs.
+        """
+        if not self.prefetch:
+            return
+        for nodeid in [nodeid for nodeid in self._prefetched if nodeid != item.nodeid]:
+            self._discard(*self._prefetched.pop(nodeid))  # e.g. skipped
+        if nextitem is None or "datafiles" not in getattr(nextitem, "fixturenames", ()):
+            return
+        marks = self.marks.get(nextitem.nodeid)
+        if marks is None or marks.options["lazy"] or marks.options["location"] == "ram":
+            return
+        if item.nodeid in self.reusable:  # the datafiles are probably handed over
+            return
+        basetemp = item.config._tmp_path_factory.getbasetemp()
+        staging_root = basetemp / "datafiles-prefetch"
+        staging_root.mkdir(exist_ok=True)
+        staging = Path(tempfile.mkdtemp(dir=staging_root))
+        if self._prefetcher is None:
+            self._prefetcher = ThreadPoolExecutor(max_workers=1)
+        future = self._prefetcher.submit(self._prefetch, marks, staging, basetemp)
+        self._prefetched[nextitem.nodeid] = (staging, future)
+
+    def _prefetch(self, marks: "_Marks", staging: Path, basetemp: Path):
+        """Copies the datafiles of 'marks' to 'staging' (in the background)."""
+        all_entries, copy_mode = self.prepare_all(marks, basetemp)
+        plan = _plan_marks(all_entries, staging, marks.options)
+        stats = {"copy_mode": copy_mode}
+        stats.update(_execute_plan(plan, copy_mode, self.workers, self.copy_function()))
+        return plan, stats
+
+    @staticmethod
+    def _discard(staging: Path, future: Future):
+        """Removes an unused prefetched directory once it's complete."""
+        future.add_done_callback(lambda _: shutil.rmtree(staging, ignore_errors=True))
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_runtest_teardown(self, item, nextitem):
+        """Remember 'nextitem' for 'hand_over' (the fixtures are torn down later)."""
+        self._nextitem = nextitem
+        self._handoff = None
+
+    def hand_over(self, marks: "_Marks", root: Path, plan, manifest) -> bool:
+        """
+        Called when the 'datafiles' of a test are torn down: if the next test
+        has the same 'marks' and the test didn't change the datafiles in
+        'root' (compared to 'manifest'), they are handed over to it. Returns
+        whether they were handed over.
+        """
+        nextitem = self._nextitem
+        if (
+            nextitem is not None
+            and "datafiles" in getattr(nextitem, "fixturenames", ())
+            and getattr(self.marks.get(nextitem.nodeid), "key", None) == marks.key
+            and _manifest(root) == manifest
+        ):
+            self._handoff = (nextitem.nodeid, root, plan, marks.options["copy_mode"])
+            return True
+        return False
+
+    def retire(self, nodeid: str, root: Path, plan: "_CopyPlan"):
+        """
+        Called when the 'datafiles' of the test 'nodeid' in 'root' are torn
+        down: unless the retention policy keeps them, the entries of 'plan'
+        are removed in the background (see '_remove_tree').
+        """
+        if self.retain == "all" or (self.retain == "failed" and nodeid in self._failed):
+            return
+        targets = (*plan.dirs, *plan.symlinks, *plan.files)
+        prefix = os.path.join(str(root), "")
+        top_level = {
+            prefix + target[len(prefix) :].split(os.sep)[0]
+            for target in targets
+            if target.startswith(prefix)
+        }
+        if self._remover is None:
+            self._remover = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="datafiles-remover"
+            )
+            self._deleter = ThreadPoolExecutor(thread_name_prefix="datafiles-deleter")
+        for path in sorted(top_level):
+            self._remover.submit(_remove_tree, path, self._deleter)
+
+    def ram_directory(self, name: str, plan: "_CopyPlan") -> Optional[Path]:
+        """
+        Returns a new directory in RAM (below '_RAM_DIR') for the files of
+        'plan' and reserves their size. Returns None if there's no tmpfs or
+        the files don't fit into the budget, which is shared by all
+        pytest-xdist workers.
+        """
+        # every file occupies whole pages, holes of sparse files none
+        size = sum(
+            -(-planned.allocated // _RAM_PAGE_SIZE) * _RAM_PAGE_SIZE
+            for planned in plan.files.values()
+        )
+        if size > self.ram_size:
+            return None
+        if self._ram_root is None:
+            if not os.path.isdir(_RAM_DIR) or not os.access(_RAM_DIR, os.W_OK):
+                return None
+            self._ram_root = Path(
+                tempfile.mkdtemp(prefix="pytest-datafiles-", dir=_RAM_DIR)
+            )
+        prefix = re.sub(r"[\W]", "_", name)[:30] + "-"
+
+        def reserve(reservations: Dict[str, int]) -> Optional[Path]:
+            if sum(reservations.values()) + size > self.ram_size:
+                return None
+            directory = tempfile.mkdtemp(prefix=prefix, dir=self._ram_root)
+            reservations[directory] = size
+            return Path(directory)
+
+        return self._update_ram_reservations(reserve)
+
+    def release_ram(self, directory: Path):
+        """Removes the 'directory' in RAM and releases its reservation."""
+        shutil.rmtree(directory, ignore_errors=True)
+        self._update_ram_reservations(
+            lambda reservations: reservations.pop(str(directory), None)
+        )
+
+    def _update_ram_reservations(self, update):
+        """
+        Calls 'update' with the RAM reservations (directory -> bytes) and
+        returns its result. pytest-xdist workers keep the reservations of all
+        of them in a file next to their base temporary directories, guarded by
+        a file lock; reservations of directories that don't exist anymore
+        (e.g. of a crashed worker) are dropped.
+        """
+        if not self.xdist_worker:
+            return update(self._ram_used)
+        root = self._config._tmp_path_factory.getbasetemp().parent
+        path = root / "datafiles-ram.json"
+        with _FileLock(root / "datafiles-ram.lock"):
+            try:
+                reservations = json.loads(path.read_text())
+            except (FileNotFoundError, ValueError):
+                reservations = {}
+            reservations = {
+                directory: size
+                for directory, size in reservations.items()
+                if os.path.isdir(directory)
+            }
+            result = update(reservations)
+            path.write_text(json.dumps(reservations))
+        return result
+
+    def claim(self, nodeid: str, target: Path) -> "Optional[Tuple[_CopyPlan, dict]]":
+        """
+        Moves the datafiles handed over from the previous test or the
+        prefetched ones (waiting for them if necessary) of the test 'nodeid'
+        to the empty directory 'target' and returns the plan and the
+        statistics of the copy. Returns None if there are none, the prefetch
+        failed (the regular setup reports the error) or 'target' isn't empty.
+        """
+        handoff, self._handoff = self._handoff, None
+        if handoff is not None and handoff[0] == nodeid and not os.listdir(target):
+            _, root, plan, copy_mode = handoff
+            _move_entries(root, target)
+            plan.rebase(str(root), str(target))
+            return plan, {"copy_mode": copy_mode, "reused": True}
+        if nodeid not in self._prefetched:
+            return None
+        staging, future = self._prefetched.pop(nodeid)
+        if future.exception() is not None or os.listdir(target):
+            shutil.rmtree(staging, ignore_errors=True)
+            return None
+        plan, stats = future.result()
+        _move_entries(staging, target)
+        os.rmdir(staging)
+        plan.rebase(str(staging), str(target))
+        stats["prefetched"] = True
+        return plan, stats
+
+    def pytest_report_collectionfinish(self):
+        """Report all tests with invalid marks before any test runs."""
+        if not self.invalid:
+            return None
+        return ["Invalid datafiles marks (the setup of these tests fails):"] + [
+            f"  {nodeid}: {type(error).__name__}: {error}"
+            for nodeid, error in self.invalid.items()
+        ]
+
+    def record_stats(self, node, stats: dict):
+        """
+        Records the statistics dictionary 'stats' of a datafiles setup of the
+        test item 'node' (see 'datafiles_stats').
+        """
+        self.stats.setdefault(node.nodeid, []).append(stats)
+        if self.user_properties:
+            node.user_properties.append(("datafiles", stats))
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_makereport(self, item, call):
+        """
+        Attach the statistics of the datafiles setups of a test to its
+        teardown report (as 'datafiles'), so that they reach the
+        pytest-xdist controller as well.
+        """
+        outcome = yield
+        if call.when == "teardown":
+            outcome.get_result().datafiles = self.stats.pop(item.nodeid, [])
+
+    def pytest_runtest_logreport(self, report):
+        """
+        Collect the statistics of the datafiles setups of a test and
+        remember failed tests for the retention policy.
+        """
+        if report.failed and report.when != "teardown":
+            self._failed.add(report.nodeid)
+        if report.when == "teardown":
+            for stats in getattr(report, "datafiles", ()):
+                self.reports.append((report.nodeid, stats))
+
+    def pytest_sessionfinish(self):
+        """
+        Stop prefetching, wait for the removal of the datafiles, save the
+        persistent store and write the JSON report.
+        """
+        for staging, future in self._prefetched.values():
+            self._discard(staging, future)
+        self._prefetched.clear()
+        if self._prefetcher is not None:
+            self._prefetcher.shutdown()
+        if self._remover is not None:
+            self._remover.shutdown()
+            self._deleter.shutdown()
+        if self._ram_root is not None:
+            shutil.rmtree(self._ram_root, ignore_errors=True)
+        if self._config.pluginmanager.has_plugin("dsession"):  # xdist controller
+            basetemp = self._config._tmp_path_factory.getbasetemp()
+            shutil.rmtree(basetemp / "datafiles-cache", ignore_errors=True)
+            shutil.rmtree(basetemp / "datafiles-links", ignore_errors=True)
+            shutil.rmtree(basetemp / "datafiles-generated", ignore_errors=True)
+        if self.persistent is not None:
+            # the controller prunes the store after all workers saved it
+            self.persistent.save(prune=not self.xdist_worker)
+        if self.report_json:
+            report = {
+                "totals": self.totals(),
+                "setups": [
+                    {"nodeid": nodeid, **stats} for nodeid, stats in self.reports
+                ],
+            }
+            with open(self.report_json, "w", encoding="utf-8") as report_file:
+                json.dump(report, report_file, indent=2, sort_keys=True)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        """Show the slowest and the largest datafiles setups."""
+        if self.report_count is None:
+            return
+        write_line = terminalreporter.write_line
+        terminalreporter.write_sep("=", "datafiles report")
+        totals = self.totals()
+        write_line(
+            f"{totals['setups']} setups: {totals['duration']:.2f}s, "
+            f"{totals['files']} files, {totals['dirs']} dirs, "
+            f"{_format_size(totals['bytes'])} "
+            f"({_format_size(totals['allocated'])} allocated)"
+        )
+        count = self.report_count or len(self.reports)
+        for title, key in (("slowest", "duration"), ("largest", "bytes")):
+            write_line("")
+            write_line(f"{title} datafiles setups:")
+            reports = sorted(
+                self.reports, key=lambda report: report[1].get(key, 0), reverse=True
+            )
+            for nodeid, stats in reports[:count]:
+                strategies = stats.get("strategies") or {stats["copy_mode"]: 0}
+                write_line(
+                    f"{stats.get('duration', 0):8.2f}s "
+                    f"{stats.get('files', 0):7} files "
+                    f"{_format_size(stats.get('bytes', 0)):>10} "
+                    f"{','.join(sorted(strategies)):<16} {nodeid}"
+                )
+
+    def totals(self) -> dict:
+        """Returns the statistics of all datafiles setups added up."""
+        totals = dict.fromkeys(_REPORT_TOTALS, 0)
+        for _, stats in self.reports:
+            for key in _REPORT_TOTALS:
+                totals[key] += stats.get(key, 0)
+        totals["setups"] = len(self.reports)
+        return totals
+
+    def prepare(
+        self, entry_list: List, options: dict, basetemp: Path
+    ) -> Tuple[List[Path], str]:
+        """
+        Returns the paths to copy the marked 'entry_list' from and the copy
+        mode to use: generated entries are generated, archives are extracted
+        (with 'extract=True'), compressed files decompressed (with
+        'decompress=True') and the other sources replaced by their snapshots
+        if the session cache is enabled or the files are hard linked.
+        """
+        copy_mode = options["copy_mode"]
+        entries = [
+            entry if isinstance(entry, _Generated) else Path(entry)
+            for entry in entry_list
+        ]
+        # generated, extracted and decompressed entries are private, they
+        # aren't snapshotted
+        is_archive = [
+            not isinstance(entry, _Generated)
+            and options["extract"]
+            and _archive_suffix(entry) is not None
+            for entry in entries
+        ]
+        is_produced = [
+            archive
+            or isinstance(entry, _Generated)
+            or (options["decompress"] and _compression_suffix(entry) is not None)
+            for entry, archive in zip(entries, is_archive)
+        ]
+        # nothing is copied with copy_mode "none", so snapshots are useless
+        snapshots = None if copy_mode == "none" else self.snapshots
+        cache_dir = "datafiles-cache"
+        if copy_mode == "hardlink":
+            snapshots, cache_dir = self.link_sources, "datafiles-links"
+        if snapshots is None and not any(is_produced):
+            return entry_list, copy_mode
+        if snapshots is not None:
+            # the base temporary directories of xdist workers share the parent
+            root = basetemp.parent if self.xdist_worker else basetemp
+            snapshots = iter(
+                snapshots.get(
+                    [e for e, produced in zip(entries, is_produced) if not produced],
+                    root / cache_dir,
+                )
+            )
+            entries = [
+                entry if produced else next(snapshots)
+                for entry, produced in zip(entries, is_produced)
+            ]
+            if copy_mode == "copy":
+                # the snapshots are private, so they can be cloned safely
+                copy_mode = "reflink"
+        for index, entry in enumerate(entries):
+            if isinstance(entry, _Generated):
+                entries[index] = self.generate(entry, basetemp)
+            elif is_archive[index]:
+                entries[index] = self.extract(entry, basetemp / "datafiles-archives")
+            elif is_produced[index]:
+                entries[index] = self.decompress(
+                    entry, basetemp / "datafiles-decompressed"
+                )
+        return entries, copy_mode
+
+    def prepare_all(
+        self, marks: "_Marks", basetemp: Path, pinned: Optional[List[str]] = None
+    ) -> Tuple[List[Path], str]:
+        """
+        Like 'prepare', but returns the entries to copy (see
+        '_get_all_entries') of the resolved 'marks'. The marked directories
+        are listed for every setup, so entries added after the collection
+        (e.g. by session fixtures) are copied as well. If a list 'pinned' is
+        given, the snapshots used are pinned (see '_SnapshotCache.pin') and
+        their keys appended to it.
+        """
+        with self._lock:
+            entries, copy_mode = self.prepare(marks.entries, marks.options, basetemp)
+            if pinned is not None and self.snapshots is not None:
+                pinned.extend(self.snapshots.pin(entries))
+        all_entries = self.hook.pytest_datafiles_resolve(
+            entries=entries, options=marks.options
+        )
+        return all_entries, copy_mode
+
+    def unpin_snapshots(self, keys: List[str]):
+        """Unpins the snapshots pinned by 'prepare_all'."""
+        if keys:
+            with self._lock:
+                self.snapshots.unpin(keys)
+
+    def copy_function(self):
+        """
+        Returns the function used to copy a file (see '_copy_file'): the
+        'pytest_datafiles_copy' hook if another plugin implements it,
+        '_copy_file' itself otherwise (saving a hook call per file).
+        """
+        hook = self.hook.pytest_datafiles_copy
+        if len(hook.get_hookimpls()) == 1:
+            return _copy_file
+
+        def copy_file(src, dst, copy_mode, copy_metadata):
+            return hook(
+                source=src, target=dst, copy_mode=copy_mode, copy_metadata=copy_metadata
+            )
+
+        return copy_file
+
+    def generate(self, entry: _Generated, basetemp: Path) -> Path:
+        """
+        Returns the directory with the output of the generated 'entry',
+        calling its factory only once per session or, with the persistent
+        store, once for all runs. pytest-xdist workers share the output below
+        the common parent of their base temporary directories: the first
+        worker that needs it generates it, guarded by a file lock.
+        """
+        key = entry.cache_key
+        if key not in self._generated:
+            root = basetemp.parent if self.xdist_worker else basetemp
+            root = root / "datafiles-generated"
+            root.mkdir(parents=True, exist_ok=True)
+            with _FileLock(root / f"{key}.lock"):
+                if self.persistent is not None:
+                    directory = self.persistent.get(
+                        f"generated-{key}", entry.name, entry.factory
+                    )
+                else:
+                    directory = root / key / entry.name
+                    if not directory.is_dir():
+                        staging = Path(tempfile.mkdtemp(prefix=".staging-", dir=root))
+                        try:
+                            (staging / entry.name).mkdir()
+                            entry.factory(staging / entry.name)
+                            os.rename(staging, root / key)
+                        finally:
+                            shutil.rmtree(staging, ignore_errors=True)
+            self._generated[key] = directory
+        return self._generated[key]
+
+    def extract(self, archive: Path, root: Path) -> Path:
+        """
+        Returns a directory (below 'root') with the extracted content of
+        'archive', named like 'archive' without the suffix. Every archive is
+        only extracted once per session (unless it is modified) or, with the
+        persistent store, once for all runs.
+        """
+        key, _ = _fingerprint(archive)
+        if key not in self._extracted:
+            name = archive.name[: -len(_archive_suffix(archive))]
+            if self.persistent is not None:
+                self._extracted[key] = self.persistent.get(
+                    f"archive-{name}-{self.persistent.content_hash(archive)}",
+                    name,
+                    lambda target: _extract_archive(archive, target),
+                )
+                return self._extracted[key]
+            target = root / key / name
+            shutil.rmtree(target.parent, ignore_errors=True)
+            target.mkdir(parents=True)
+            _extract_archive(archive, target)
+            self._extracted[key] = target
+        return self._extracted[key]
+
+    def decompress(self, source: Path, root: Path) -> Path:
+        """
+        Returns a file (below 'root') with the decompressed content of
+        'source', named like 'source' without the suffix. Every file is only
+        decompressed once per session (unless it is modified) or, with the
+        persistent store, once for all runs.
+        """
+        key, _ = _fingerprint(source)
+        if key not in self._decompressed:
+            name = source.name[: -len(_compression_suffix(source))]
+            if self.persistent is not None:
+                directory = self.persistent.get(
+                    f"decompressed-{name}-{self.persistent.content_hash(source)}",
+                    "decompressed",
+                    lambda target: _decompress_file(source, target / name),
+                )
+                self._decompressed[key] = directory / name
+                return self._decompressed[key]
+            target = root / key / name
+            shutil.rmtree(target.parent, ignore_errors=True)
+            target.parent.mkdir(parents=True)
+            _decompress_file(source, target)
+            self._decompressed[key] = target
+        return self._decompressed[key]
+
+
+def _is_sparse(stat_result) -> bool:
+    """Returns whether the file of 'stat_result' has holes (if detectable)."""
+    return _allocated_size(stat_result) < stat_result.st_size
+
+
+def _allocated_size(stat_result) -> int:
+    """
+    Returns the bytes allocated on disk for the file of 'stat_result' (its
+    size where the filesystem doesn't report blocks, e.g. on Windows).
+    """
+    blocks = getattr(stat_result, "st_blocks", None)
+    return stat_result.st_size if blocks is None else blocks * 512
+
+
+def _copy_range(fd_src: int, fd_dst: int, offset: int, count: int):
+    """
+    Copies 'count' bytes at 'offset' of 'fd_src' to the same offset of
+    'fd_dst', in the kernel with copy_file_range if possible.
+    """
+    end = offset + count
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < end:
+                copied = os.copy_file_range(
+                    fd_src, fd_dst, end - offset, offset, offset
+                )
+                if copied == 0:
+                    return
+                offset += copied
+            return
+        except OSError:  # e.g. not supported by the filesystem
+            pass
+    while offset < end:
+        chunk = os.pread(fd_src, min(end - offset, 1024 * 1024), offset)
+        if not chunk:
+            return
+        os.pwrite(fd_dst, chunk, offset)
+        offset += len(chunk)
+
+
+def _copy_sparse(fd_src: int, fd_dst: int, size: int):
     """
-    Copies all entries (files, dirs) from 'entry_list' to 'target_dir' taking
-    into account the 'on_duplicate' option (which defines what should happen if
-    an entry already exists: raise an exception, overwrite it or ignore it).
+    Copies the 'size' bytes of 'fd_src' to 'fd_dst' preserving holes: only
+    the data segments found with SEEK_DATA/SEEK_HOLE are copied, the holes
+    are skipped and 'fd_dst' is truncated to 'size'.
     """
+    offset = 0
+    while offset < size:
+        try:
+            data = os.lseek(fd_src, offset, os.SEEK_DATA)
+        except OSError as error:
+            if error.errno == errno.ENXIO:  # only a hole is left
+                break
+            raise
+        hole = os.lseek(fd_src, data, os.SEEK_HOLE)
+        _copy_range(fd_src, fd_dst, data, hole - data)
+        offset = hole
+    os.ftruncate(fd_dst, size)
+
+
+def _copy_content(src, dst) -> str:
+    """
+    Copies the content of the file 'src' to 'dst' and returns the name of the
+    strategy that was used: 'sparse' if the holes of a sparse file were
+    preserved (see '_copy_sparse'), 'copy' for a regular copy (with sendfile
+    where supported, like 'shutil.copyfile').
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        stat_result = os.fstat(fsrc.fileno())
+        if _copy_holes(fsrc, fdst, stat_result):
+            return "sparse"
+        size = stat_result.st_size
+        if hasattr(os, "sendfile"):
+            try:
+                offset = 0
+                while offset < size:
+                    sent = os.sendfile(
+                        fdst.fileno(), fsrc.fileno(), offset, size - offset
+                    )
+                    if sent == 0:
+                        break
+                    offset += sent
+                return "copy"
+            except OSError:  # e.g. not supported for regular files
+                fdst.seek(0)
+                fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst)
+    return "copy"
+
+
+def _copy_holes(fsrc, fdst, stat_result) -> bool:
+    """
+    Copies the open file 'fsrc' (with the 'stat_result') to 'fdst' with
+    '_copy_sparse' if it is sparse and the platform supports SEEK_DATA.
+    Returns whether it did.
+    """
+    if not hasattr(os, "SEEK_DATA") or not _is_sparse(stat_result):
+        return False
+    try:
+        _copy_sparse(fsrc.fileno(), fdst.fileno(), stat_result.st_size)
+        return True
+    except OSError:  # e.g. SEEK_DATA not supported by the filesystem
+        fdst.seek(0)
+        fdst.truncate()
+        return False
+
+
+def _reflink_file(src, dst) -> str:
+    """
+    Copies the content of the file 'src' to 'dst' as cheaply as possible and
+    returns the name of the strategy that was used.
+
+    First a copy-on-write clone (FICLONE, supported e.g. by btrfs and XFS) is
+    attempted, then (for sparse files) a copy preserving the holes (see
+    '_copy_sparse'), an in-kernel copy with copy_file_range (which may also
+    share blocks, depending on the filesystem) and finally a regular copy.
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                return "reflink"
+            except OSError:
+                pass
+        stat_result = os.fstat(fsrc.fileno())
+        if _copy_holes(fsrc, fdst, stat_result):
+            return "sparse"
+        if hasattr(os, "copy_file_range"):
+            try:
+                remaining = stat_result.st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                return "copy_file_range"
+            except OSError:
+                fdst.truncate(0)
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+def _hardlink_file(src, dst) -> str:
+    """
+    Creates 'dst' as a hard link to 'src' and returns the name of the strategy
+    that was used.
+
+    Because the link shares its inode with 'src', the write permission bits
+    are removed from it (and hence from 'src' as well) so that a test can't
+    modify 'src' through the link, which is why 'src' must be a private copy
+    (see '_DatafilesState.prepare'). This doesn't protect against tests
+    running as root, which ignores the permission bits. If linking is not possible
+    (e.g. 'dst' is on a different filesystem) a copy is made instead (see
+    '_copy_content').
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        strategy = _copy_content(src, dst)
+        shutil.copymode(src, dst)
+        return strategy
+    mode = os.stat(dst).st_mode
+    if mode & _WRITE_BITS:
+        os.chmod(dst, stat.S_IMODE(mode) & ~_WRITE_BITS)
+    return "hardlink"
+
+
+def _copy_file(src, dst, copy_mode: str, copy_metadata) -> str:
+    """
+    Copies the file 'src' to 'dst' according to 'copy_mode' and returns the
+    name of the strategy that was used. 'copy_metadata' (e.g.
+    'shutil.copymode') is applied afterwards unless the file was linked.
+    With copy_mode "none" 'dst' is a symlink to (the absolute path of) 'src'.
+    """
+    if copy_mode == "none":
+        os.symlink(os.path.abspath(src), dst)
+        return "symlink"
+    if copy_mode == "hardlink":
+        return _hardlink_file(src, dst)
+    if copy_mode == "reflink":
+        strategy = _reflink_file(src, dst)
+    else:
+        strategy = _copy_content(src, dst)
+    copy_metadata(src, dst)
+    return strategy
+
+
+class _PlannedFile(NamedTuple):
+    """
+    A file of a '_CopyPlan': the 'source', the function applying its metadata
+    to the copy (see '_copy_file'), its (apparent) 'size' in bytes and the
+    bytes 'allocated' for it on disk, which are less for sparse files.
+    """
+
+    source: str
+    copy_metadata: object
+    size: int
+    allocated: int
+
+
+class _StatCopier:
+    """
+    Applies the mode (and with 'times' the access and modification times) of
+    the cached 'stat_result' of a source file to a copy, like
+    'shutil.copymode' ('shutil.copystat') but without stat-ing the source
+    again.
+    """
+
+    __slots__ = ("stat_result", "times")
+
+    def __init__(self, stat_result, times: bool):
+        self.stat_result = stat_result
+        self.times = times
+
+    def __call__(self, src, dst):
+        if self.times:
+            os.utime(
+                dst, ns=(self.stat_result.st_atime_ns, self.stat_result.st_mtime_ns)
+            )
+        os.chmod(dst, stat.S_IMODE(self.stat_result.st_mode))
+
+
+def _no_metadata(src, dst):
+    """Doesn't copy any metadata (for 'preserve_metadata=False')."""
+
+
+class _CopyPlan:
+    """
+    Everything that has to be done to copy the marked entries, resolved up
+    front: the directories to create, the symlinks to recreate and the files
+    to copy, each as a target -> source mapping in a deterministic order.
+    Every target appears only once, so every file is copied exactly once.
+
+    'shadowed' lists the (source, target) pairs of marked entries that are
+    not copied at all because of 'on_duplicate', 'remove' the existing
+    entries in the target directory that are overwritten. Without
+    'preserve_metadata' only the content of the files is copied.
+    """
+
+    def __init__(self, preserve_metadata: bool = True):
+        self.preserve_metadata = preserve_metadata
+        self.dirs: Dict[str, str] = {}
+        self.symlinks: Dict[str, str] = {}
+        self.files: Dict[str, _PlannedFile] = {}
+        self.shadowed: List[Tuple[str, str]] = []
+        self.remove: List[str] = []
+
+    def __repr__(self):
+        return (
+            f"<CopyPlan dirs={len(self.dirs)} symlinks={len(self.symlinks)} "
+            f"files={len(self.files)} shadowed={len(self.shadowed)}>"
+        )
+
+    def add_tree(
+        self,
+        source: Path,
+        target: Path,
+        entry_filter: "Optional[_EntryFilter]" = None,
+        relpath: str = "",
+    ):
+        """
+        Adds the directory 'source' (recursively) as 'target'. Entries
+        rejected by 'entry_filter' are skipped (rejected directories are not
+        even walked), 'relpath' is the path of 'target' relative to the
+        datafiles directory the filter patterns are matched against.
+
+        The tree is walked with 'os.scandir': the type of an entry usually
+        comes with the directory listing and only files are stat-ed, once, for
+        their size and metadata.
+        """
+        self.dirs[str(target)] = str(source)
+        pending = [(str(source), str(target), relpath)]
+        while pending:
+            src_dir, dst_dir, rel_dir = pending.pop()
+            with os.scandir(src_dir) as scanned:
+                entries = sorted(scanned, key=lambda entry: entry.name)
+            subdirs = []
+            for entry in entries:
+                dst = os.path.join(dst_dir, entry.name)
+                rel = f"{rel_dir}/{entry.name}"
+                is_link = entry.is_symlink()
+                is_dir = not is_link and entry.is_dir()
+                if entry_filter is not None and not entry_filter.accepts(
+                    entry.path, rel, is_dir
+                ):
+                    continue
+                if is_link:
+                    self.symlinks[dst] = entry.path
+                elif is_dir:
+                    self.dirs[dst] = entry.path
+                    subdirs.append((entry.path, dst, rel))
+                else:
+                    self.add_file(entry.path, dst, entry.stat(follow_symlinks=False))
+            pending.extend(reversed(subdirs))  # depth first, in order
+
+    def add_file(self, source: str, target: str, stat_result, times: bool = True):
+        """
+        Adds the file 'source' with the (cached) 'stat_result' as 'target'.
+        Its mode (and with 'times' its access and modification times) are
+        copied from 'stat_result' unless metadata isn't preserved.
+        """
+        copy_metadata = (
+            _StatCopier(stat_result, times) if self.preserve_metadata else _no_metadata
+        )
+        self.files[target] = _PlannedFile(
+            source, copy_metadata, stat_result.st_size, _allocated_size(stat_result)
+        )
+
+    def discard(self, target: str):
+        """Removes 'target' and everything below it from the plan."""
+        prefix = os.path.join(target, "")
+        for mapping in (self.dirs, self.symlinks, self.files):
+            for key in [k for k in mapping if k == target or k.startswith(prefix)]:
+                del mapping[key]
+
+    def rebase(self, old: str, new: str):
+        """Moves all targets from the directory 'old' to 'new'."""
+
+        def move(path: str) -> str:
+            return new + path[len(old) :]
+
+        self.dirs = {move(dst): src for dst, src in self.dirs.items()}
+        self.symlinks = {move(dst): src for dst, src in self.symlinks.items()}
+        self.files = {move(dst): planned for dst, planned in self.files.items()}
+        self.shadowed = [(src, move(dst)) for src, dst in self.shadowed]
+        self.remove = [move(dst) for dst in self.remove]
+
+    def prune_dirs(self):
+        """Removes the directories without any file or symlink below them."""
+        needed = set()
+        for path in (*self.files, *self.symlinks):
+            parent = os.path.dirname(path)
+            while parent in self.dirs and parent not in needed:
+                needed.add(parent)
+                parent = os.path.dirname(parent)
+        self.dirs = {dst: src for dst, src in self.dirs.items() if dst in needed}
+
+
+class _EntryFilter:
+    """
+    The 'include' and 'exclude' options of the 'datafiles' marks. Each is a
+    glob pattern, a callable or a list of them. Patterns are matched against
+    the path of an entry relative to the datafiles directory (with '/' as
+    separator) if they contain a '/', against its name otherwise. Callables
+    are called with the path of the source and return True for a match.
+    """
+
+    def __init__(self, include, exclude):
+        self.include = self._rules(include)
+        self.exclude = self._rules(exclude)
+
+    @classmethod
+    def from_options(cls, options: dict) -> "Optional[_EntryFilter]":
+        """Returns the filter of the marker 'options', None if there's none."""
+        if options["include"] is None and options["exclude"] is None:
+            return None
+        return cls(options["include"], options["exclude"])
+
+    @staticmethod
+    def validate(name: str, value):
+        """Raises ValueError if 'value' isn't valid for the option 'name'."""
+        rules = value if isinstance(value, (list, tuple)) else [value]
+        if value is None or all(
+            isinstance(rule, str) or callable(rule) for rule in rules
+        ):
+            return
+        raise ValueError(
+            f"'{name}' must be a glob pattern, a callable or a list of them, "
+            f"got {value!r}"
+        )
+
+    @staticmethod
+    def _rules(value) -> list:
+        if value is None:
+            return []
+        return list(value) if isinstance(value, (list, tuple)) else [value]
+
+    @staticmethod
+    def _matches(rules: list, source: str, relpath: str) -> bool:
+        for rule in rules:
+            if callable(rule):
+                if rule(Path(source)):
+                    return True
+            elif fnmatch.fnmatchcase(
+                relpath if "/" in rule else relpath.rpartition("/")[2], rule
+            ):
+                return True
+        return False
+
+    def accepts(self, source: str, relpath: str, is_dir: bool) -> bool:
+        """
+        Returns whether the entry 'source' (copied to 'relpath') is copied.
+        Excluded directories are skipped entirely, 'include' only applies to
+        files and symlinks (directories are kept if anything inside them is
+        included).
+        """
+        if self._matches(self.exclude, source, relpath):
+            return False
+        return (
+            is_dir or not self.include or self._matches(self.include, source, relpath)
+        )
+
+
+def _plan_copy(
+    entry_list: List[Path],
+    target_dir: Path,
+    on_duplicate: str,
+    entry_filter: Optional[_EntryFilter] = None,
+    preserve_metadata: bool = True,
+) -> _CopyPlan:
+    """
+    Resolves what has to be done to copy all entries (files, dirs) from
+    'entry_list' to 'target_dir' taking into account the 'on_duplicate' option
+    (which defines what should happen if an entry already exists: raise an
+    exception, overwrite it or ignore it). Entries rejected by 'entry_filter'
+    are left out (and are no duplicates). Nothing is copied yet.
+
+    Every entry is stat-ed at most once: the existing entries of 'target_dir'
+    are listed once instead of checking every target.
+    """
+    plan = _CopyPlan(preserve_metadata)
+    try:
+        existing = set(os.listdir(target_dir))
+    except FileNotFoundError:
+        existing = set()
+    claimed: Dict[str, Path] = {}  # top-level target -> source
     for entry in entry_list:
         target_entry = target_dir / entry.name
-        if not target_entry.exists() or on_duplicate == "overwrite":
-            if entry.is_file():
-                shutil.copy(entry, target_entry, follow_symlinks=False)
-            else:
-                shutil.copytree(entry, target_entry, symlinks=True)
-        elif on_duplicate == "exception":
-            raise ValueError(f"'{target_entry}' already exists (src {entry})")
-        else:  # ignore
+        key = str(target_entry)
+        stat_result = os.lstat(entry)
+        mode = stat_result.st_mode
+        is_link = stat.S_ISLNK(mode)
+        # a marked symlink to a directory is copied like the directory
+        is_dir = stat.S_ISDIR(mode) or (is_link and os.path.isdir(entry))
+        if entry_filter is not None and not entry_filter.accepts(
+            str(entry), entry.name, is_dir
+        ):
             continue
+        if key in claimed or entry.name in existing:
+            if on_duplicate == "exception":
+                raise ValueError(f"'{target_entry}' already exists (src {entry})")
+            if on_duplicate == "ignore":
+                plan.shadowed.append((str(entry), key))
+                continue
+            if key in claimed:
+                plan.shadowed.append((str(claimed[key]), key))
+                plan.discard(key)
+            else:
+                plan.remove.append(key)
+        claimed[key] = entry
+        if is_dir:
+            plan.add_tree(entry, target_entry, entry_filter, entry.name)
+        elif is_link:
+            plan.symlinks[key] = str(entry)
+        elif stat.S_ISREG(mode):
+            plan.add_file(str(entry), key, stat_result, times=False)
+        else:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), str(entry))
+    if entry_filter is not None and entry_filter.include:
+        plan.prune_dirs()
+    return plan
+
+
+def _plan_marks(all_entries: List[Path], target_dir: Path, options: dict) -> _CopyPlan:
+    """Returns the plan to copy 'all_entries' with the marker 'options'."""
+    return _plan_copy(
+        all_entries,
+        target_dir,
+        options["on_duplicate"],
+        _EntryFilter.from_options(options),
+        options["preserve_metadata"],
+    )
+
+
+def _move_entries(source: Path, target: Path):
+    """Moves all entries of the directory 'source' into 'target'."""
+    for name in os.listdir(source):
+        os.rename(source / name, target / name)
+
+
+def _remove(path: str):
+    """Removes the file, symlink or directory 'path' if it exists."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def _remove_tree(path: str, executor: ThreadPoolExecutor):
+    """
+    Removes the file, symlink or directory 'path' if it exists. The
+    directories are listed with 'os.scandir' and cleared concurrently by
+    'executor', then removed bottom-up. Directories without write permission
+    (e.g. copied with 'preserve_metadata') are made writable first. Errors
+    are ignored, like in pytest's removal of old base temporary directories.
+    """
+
+    def clear(directory: str) -> List[str]:
+        # removes the files and symlinks in 'directory', returns the subdirs
+        subdirs = []
+        with os.scandir(directory) as scanned:
+            for entry in scanned:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                else:
+                    _writable_parent(os.unlink, entry.path)
+        return subdirs
+
+    try:
+        if not os.path.isdir(path) or os.path.islink(path):
+            if os.path.lexists(path):
+                os.unlink(path)
+            return
+        dirs = [path]
+        pending = {executor.submit(clear, path)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for subdir in future.result():
+                    dirs.append(subdir)
+                    pending.add(executor.submit(clear, subdir))
+        for directory in reversed(dirs):  # every directory after its parent
+            _writable_parent(os.rmdir, directory)
+    except OSError:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _writable_parent(remove, path: str):
+    """Calls 'remove(path)', making the parent of 'path' writable if needed."""
+    try:
+        remove(path)
+    except PermissionError:
+        os.chmod(os.path.dirname(path), stat.S_IRWXU)
+        remove(path)
+
+
+def _create_skeleton(plan: _CopyPlan):
+    """
+    Removes the overwritten entries and creates the directories and symlinks
+    of 'plan'.
+    """
+    for dst in plan.remove:
+        _remove(dst)
+    for dst in plan.dirs:
+        os.makedirs(dst, exist_ok=True)
+    for dst, src in plan.symlinks.items():
+        os.symlink(os.readlink(src), dst)
+        if plan.preserve_metadata:
+            shutil.copystat(src, dst, follow_symlinks=False)
+
+
+def _execute_plan(
+    plan: _CopyPlan, copy_mode: str, workers: int = 1, copy_file=_copy_file
+) -> dict:
+    """
+    Executes 'plan': creates the directories and symlinks first and then
+    copies the files with 'copy_file' (see '_copy_file'), using 'workers'
+    threads if there is more than one.
+    Returns the number of 'files', 'dirs' and 'symlinks' created, the 'bytes'
+    copied (the apparent size of the files), the bytes 'allocated' for them
+    by the sources and how many files were copied with each of the
+    'strategies'.
+    """
+    _create_skeleton(plan)
+    jobs = plan.files.items()
+
+    def copy_job(job):
+        dst, (src, copy_metadata, size, allocated) = job
+        return copy_file(src, dst, copy_mode, copy_metadata), size, allocated
+
+    if workers > 1 and len(jobs) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            copied = list(executor.map(copy_job, jobs))
+    else:
+        copied = list(map(copy_job, jobs))
+    if plan.preserve_metadata:
+        for dst, src in reversed(plan.dirs.items()):
+            shutil.copystat(src, dst)
+    return {
+        "files": len(copied),
+        "dirs": len(plan.dirs),
+        "symlinks": len(plan.symlinks),
+        "bytes": sum(size for _, size, _ in copied),
+        "allocated": sum(allocated for _, _, allocated in copied),
+        "strategies": dict(Counter(strategy for strategy, _, _ in copied)),
+    }
+
+
+class _LazyFiles:
+    """
+    Files of a lazily materialized 'datafiles' directory: the directories and
+    symlinks of 'plan' are created right away, the files are only copied the
+    first time they are accessed (or the directory containing them is
+    listed) through a '_LazyPath'.
+    """
+
+    def __init__(self, plan: _CopyPlan, copy_mode: str, copy_file=_copy_file):
+        _create_skeleton(plan)
+        self.pending = dict(plan.files)
+        self.copy_mode = copy_mode
+        self.copy_file = copy_file
+        self.strategies = Counter()
+        self.materialized = 0
+        self.bytes = 0
+        self.allocated = 0
+        self.duration = 0.0
+        self._lock = threading.RLock()
+
+    def access(self, path: str):
+        """Copies 'path' if it's a pending file."""
+        if path in self.pending:
+            with self._lock:
+                if path in self.pending:
+                    self._materialize(path)
+
+    def access_below(self, path: str, recursive: bool):
+        """Copies the pending files inside the directory 'path'."""
+        prefix = os.path.join(path, "")
+        with self._lock:
+            for target in list(self.pending):
+                if target.startswith(prefix) and (
+                    recursive or os.sep not in target[len(prefix) :]
+                ):
+                    self._materialize(target)
+
+    def _materialize(self, target: str):
+        start = time.perf_counter()
+        src, copy_metadata, size, allocated = self.pending.pop(target)
+        strategy = self.copy_file(src, target, self.copy_mode, copy_metadata)
+        self.strategies[strategy] += 1
+        self.materialized += 1
+        self.bytes += size
+        self.allocated += allocated
+        self.duration += time.perf_counter() - start
+
+
+# directory of an active 'datafiles' fixture value -> its attributes
+_BOUND: Dict[str, dict] = {}
+
+
+class _DatafilesPath(type(Path())):
+    """
+    Path returned by the 'datafiles' fixtures. 'plan' is the '_CopyPlan' that
+    was used to copy the files. The attributes are registered for the
+    directory of the fixture value while the fixture is active (see
+    '_bind'), so that all paths derived from it (e.g. 'datafiles / "file"')
+    share them. Pickled paths are plain paths.
+    """
+
+    @classmethod
+    def _bind(cls, path: Path, **attributes) -> "_DatafilesPath":
+        """Returns 'path' as a path of this class with 'attributes'."""
+        _BOUND[str(path)] = attributes
+        return cls(path)
+
+    @staticmethod
+    def _unbind(path: Path):
+        """Drops the attributes of 'path' when its fixture is torn down."""
+        _BOUND.pop(str(path), None)
+
+    def _attributes(self) -> dict:
+        """Returns the attributes of the fixture value containing this path."""
+        path = str(self)
+        while path not in _BOUND:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return {}
+            path = parent
+        return _BOUND[path]
+
+    def __reduce__(self):
+        return type(Path()), (str(self),)
+
+    @property
+    def plan(self) -> _CopyPlan:
+        """The plan used to copy the files (while the fixture is active)."""
+        try:
+            return self._attributes()["plan"]
+        except KeyError:
+            raise AttributeError(
+                "'plan' is only available while the datafiles fixture is active"
+            ) from None
+
+    def mmap(self, name: str = "") -> mmap.mmap:
+        """
+        Returns a read-only memory map of the file 'name' (relative to this
+        path). With 'lazy=True' a file that wasn't copied yet is mapped from
+        its source, so that large files can be parsed without being copied.
+        With copy_mode "none" the file is a symlink to its source anyway.
+        Empty files can't be mapped.
+        """
+        path = str(self / name)
+        lazy = self._attributes().get("lazy")
+        planned = lazy.pending.get(path) if lazy is not None else None
+        with open(path if planned is None else planned.source, "rb") as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _LazyPath(_DatafilesPath):
+    """
+    Path of a lazily materialized 'datafiles' directory (or of an entry in
+    it). A pending file is copied when its path is used as a file system path
+    (opening, stat-ing, passing it to 'os' functions, ...), the pending files
+    inside a directory are copied before its content is listed with
+    'iterdir', 'glob', 'rglob' or 'walk'.
+    """
+
+    def _lazy(self) -> Optional[_LazyFiles]:
+        # None after the fixture was torn down
+        return self._attributes().get("lazy")
+
+    @property
+    def materialized(self) -> int:
+        """Number of files that have been copied so far."""
+        lazy = self._lazy()
+        return lazy.materialized if lazy is not None else 0
+
+    def __fspath__(self):
+        path = str(self)
+        lazy = self._lazy()
+        if lazy is not None:
+            lazy.access(path)
+        return path
+
+    def __reduce__(self):
+        # the path may be used in another process, without this fixture
+        self.__fspath__()
+        self._access_below()
+        return super().__reduce__()
+
+    def _access_below(self, recursive: bool = True):
+        lazy = self._lazy()
+        if lazy is not None:
+            lazy.access_below(str(self), recursive=recursive)
+
+    def iterdir(self):
+        self._access_below(recursive=False)
+        return super().iterdir()
+
+    def glob(self, *args, **kwargs):
+        self._access_below()
+        return super().glob(*args, **kwargs)
+
+    def rglob(self, *args, **kwargs):
+        self._access_below()
+        return super().rglob(*args, **kwargs)
+
+    def walk(self, *args, **kwargs):
+        self._access_below()
+        return super().walk(*args, **kwargs)
 
 
 def _get_all_entries(entry_list: List[str], keep_top_dir: bool) -> List[Path]:
@@ -65,32 +2268,410 @@ def _get_all_entries(entry_list: List[str], keep_top_dir: bool) -> List[Path]:
     return all_files
 
 
-@pytest.fixture
-def datafiles(request, tmp_path: Path) -> Path:
+class _Marks(NamedTuple):
     """
-    pytest fixture to define a 'tmp_path' containing files or directories
-    specified with a 'datafiles' mark.
+    The resolved 'datafiles' marks of a test: the marked 'entries' as paths,
+    the validated 'options' and a hashable 'key' identifying the marks.
+    """
+
+    entries: Tuple[Path, ...]
+    options: dict
+    key: tuple
+
+
+def _resolve_marks(node, config: Config) -> _Marks:
+    """
+    Returns the resolved 'datafiles' marks of 'node'. Raises an exception if
+    the options are invalid or a marked entry doesn't exist.
     """
     entry_list = []
     options = {
         "keep_top_dir": False,
         "on_duplicate": "exception",  # ignore, overwrite
+        "copy_mode": config.getini("datafiles_copy_mode"),
+        "lazy": False,
+        "extract": False,
+        "include": None,
+        "exclude": None,
+        "preserve_metadata": True,
+        "location": "ram" if _get_option(config, "datafiles_basetemp_ram") else "tmp",
+        "detect_mutation": False,
+        "decompress": False,
     }
-    for mark in request.node.iter_markers("datafiles"):
+    for mark in node.iter_markers("datafiles"):
         entry_list.extend(mark.args)
         options.update(mark.kwargs)
 
     on_duplicate = options["on_duplicate"]
-    keep_top_dir = options["keep_top_dir"]
+    copy_mode = options["copy_mode"]
 
-    if keep_top_dir not in (True, False):
-        raise ValueError("'keep_top_dir' must be True or False")
+    for name in (
+        "keep_top_dir",
+        "lazy",
+        "extract",
+        "preserve_metadata",
+        "detect_mutation",
+        "decompress",
+    ):
+        if options[name] not in (True, False):
+            raise ValueError(f"'{name}' must be True or False")
     if on_duplicate not in ("exception", "ignore", "overwrite"):
         raise ValueError(
             f"'on_duplicate' must be 'exception', 'ignore' or "
             f"'overwrite', got '{on_duplicate}'"
         )
+    if copy_mode not in COPY_MODES:
+        raise ValueError(
+            f"'copy_mode' must be one of {', '.join(COPY_MODES)}, got '{copy_mode}'"
+        )
+    for name in ("include", "exclude"):
+        _EntryFilter.validate(name, options[name])
+    if options["location"] not in LOCATIONS:
+        raise ValueError(
+            f"'location' must be one of {', '.join(LOCATIONS)}, "
+            f"got '{options['location']}'"
+        )
+
+    entries = tuple(
+        entry if isinstance(entry, _Generated) else Path(entry) for entry in entry_list
+    )
+    for entry in entries:
+        if not isinstance(entry, _Generated) and not os.path.lexists(entry):
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), str(entry))
+    key = (
+        tuple(str(entry) for entry in entries),
+        tuple(sorted((name, repr(value)) for name, value in options.items())),
+    )
+    return _Marks(entries, options, key)
 
-    all_entries = _get_all_entries(entry_list, keep_top_dir)
-    _copy_all(all_entries, tmp_path, on_duplicate)
-    return tmp_path
+
+@pytest.hookimpl(trylast=True)
+def pytest_collection_modifyitems(config: Config, items) -> None:
+    """
+    Resolve and validate the 'datafiles' marks of all selected tests using
+    one of the fixtures, so that invalid marks are reported before any test
+    runs (see '_DatafilesState.pytest_report_collectionfinish') and the
+    fixtures don't have to resolve them again. The setup of the tests with
+    invalid marks fails, the other tests run as usual. Tests with a skip mark
+    are resolved by the fixtures, only if they aren't skipped.
+    """
+    state = config.pluginmanager.get_plugin("datafiles_state")
+    resolved = {}  # marks -> _Marks, shared by all tests with the same marks
+    for item in items:
+        if not _FIXTURE_NAMES.intersection(getattr(item, "fixturenames", ())):
+            continue
+        if any(item.iter_markers("skip")) or any(item.iter_markers("skipif")):
+            continue
+        raw = tuple(
+            (tuple(map(str, mark.args)), repr(sorted(mark.kwargs.items())))
+            for mark in item.iter_markers("datafiles")
+        )
+        try:
+            if raw not in resolved:
+                resolved[raw] = _resolve_marks(item, config)
+        except (ValueError, OSError) as exc:
+            state.invalid[item.nodeid] = exc
+            continue
+        state.marks[item.nodeid] = resolved[raw]
+    if state.group:
+        items[:] = _group_items(items, state.marks)
+        state.reusable = {
+            item.nodeid
+            for item, following in zip(items, items[1:])
+            if item.nodeid in state.marks
+            and state.marks[item.nodeid].key
+            == getattr(state.marks.get(following.nodeid), "key", None)
+        }
+
+
+def _group_items(items: list, marks: Dict[str, _Marks]) -> list:
+    """
+    Returns 'items' reordered so that the tests with the same resolved marks
+    and the same parent (module or class) run one after the other, at the
+    position of the first of them. Tests are not moved out of their parent, so
+    its setup and fixtures of higher scopes aren't split. The order is
+    otherwise kept, so orderings of other plugins (running earlier) stay
+    intact within the groups.
+    """
+    groups: Dict[object, list] = {}
+    for item in items:
+        resolved = marks.get(item.nodeid)
+        key = (
+            (getattr(item.parent, "nodeid", None), resolved.key)
+            if resolved is not None
+            else id(item)
+        )
+        groups.setdefault(key, []).append(item)
+    return [item for group in groups.values() for item in group]
+
+
+def _get_marks(request) -> _Marks:
+    """
+    Returns the resolved 'datafiles' marks of the test requesting a fixture.
+    """
+    state = request.config.pluginmanager.get_plugin("datafiles_state")
+    error = state.invalid.get(request.node.nodeid)
+    if error is not None:
+        raise error.with_traceback(None)
+    marks = state.marks.get(request.node.nodeid)
+    if marks is None:  # e.g. requested dynamically or with a skip mark
+        marks = _resolve_marks(request.node, request.config)
+    return marks
+
+
+def _source_state(plan: _CopyPlan) -> Dict[str, Optional[tuple]]:
+    """
+    Returns the type, mode, modification time and size of every source file
+    and directory of 'plan' (None if it doesn't exist) to detect changes.
+    """
+    state = {}
+    for source in (*plan.dirs.values(), *(p.source for p in plan.files.values())):
+        try:
+            st = os.stat(source)
+        except FileNotFoundError:
+            state[source] = None
+        else:
+            state[source] = (st.st_mode, st.st_mtime_ns, st.st_size)
+    return state
+
+
+def _manifest(root: Path) -> Dict[str, tuple]:
+    """
+    Returns the type, mode, inode, modification time and size of every entry
+    below 'root' (only the type and mode for directories).
+    """
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in dirnames + sorted(filenames):
+            path = os.path.join(dirpath, name)
+            entry_stat = os.lstat(path)
+            if stat.S_ISDIR(entry_stat.st_mode):
+                manifest[path] = (entry_stat.st_mode,)
+            else:
+                manifest[path] = (
+                    entry_stat.st_mode,
+                    entry_stat.st_ino,
+                    entry_stat.st_mtime_ns,
+                    entry_stat.st_size,
+                )
+    return manifest
+
+
+class _SharedTree:
+    """
+    A 'datafiles' directory shared by several tests. The manifest (see
+    '_manifest') taken after copying allows 'reset' to detect and restore only
+    what a test changed. 'pinned' are the keys of the session cache's
+    snapshots the files are restored from (see '_SnapshotCache.pin').
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        plan: _CopyPlan,
+        copy_mode: str,
+        copy_file=_copy_file,
+        pinned: Optional[List[str]] = None,
+    ):
+        self.root = root
+        self.pinned = pinned or []
+        self.plan = plan
+        self.copy_mode = copy_mode
+        self.copy_file = copy_file
+        self.manifest = _manifest(root)
+
+    def reset(self) -> int:
+        """
+        Restores the original state of the directory, returns the number of
+        entries that had to be restored.
+        """
+        current = _manifest(self.root)
+        if current == self.manifest:
+            return 0
+        for path in sorted(set(current) - set(self.manifest), reverse=True):
+            _remove(path)
+        restored = 0
+        for path, entry in self.manifest.items():  # parents before children
+            if current.get(path) != entry:
+                self._restore(path)
+                restored += 1
+        self.manifest = _manifest(self.root)
+        return restored
+
+    def _restore(self, path: str):
+        """Restores the entry 'path' from its source."""
+        if path in self.plan.dirs:
+            if not os.path.isdir(path) or os.path.islink(path):
+                _remove(path)
+                os.mkdir(path)
+            os.chmod(path, stat.S_IMODE(self.manifest[path][0]))
+            return
+        _remove(path)
+        if path in self.plan.symlinks:
+            os.symlink(os.readlink(self.plan.symlinks[path]), path)
+        else:
+            src, copy_metadata, _, _ = self.plan.files[path]
+            self.copy_file(src, path, self.copy_mode, copy_metadata)
+
+
+def _shared_datafiles(request, trees: dict, scope: str, tmp_path_factory) -> Path:
+    """
+    Implementation of the 'datafiles_module' and 'datafiles_session'
+    fixtures: 'trees' maps the marks to the '_SharedTree' of the scope.
+    """
+    start = time.perf_counter()
+    marks = _get_marks(request)
+    options = marks.options
+    key = marks.key
+    stats = {"copy_mode": options["copy_mode"], "scope": scope}
+    state = request.config.pluginmanager.get_plugin("datafiles_state")
+    state.record_stats(request.node, stats)
+    if key in trees:
+        stats["restored"] = trees[key].reset()
+    else:
+        basetemp = tmp_path_factory.getbasetemp()
+        pinned = []
+        all_entries, copy_mode = state.prepare_all(marks, basetemp, pinned)
+        root = tmp_path_factory.mktemp(f"datafiles_{scope}")
+        plan = _plan_marks(all_entries, root, options)
+        copy_file = state.copy_function()
+        stats.update(_execute_plan(plan, copy_mode, state.workers, copy_file))
+        trees[key] = _SharedTree(root, plan, copy_mode, copy_file, pinned)
+    stats["duration"] = time.perf_counter() - start
+    path = _DatafilesPath._bind(trees[key].root, plan=trees[key].plan)
+    request.config.hook.pytest_datafiles_materialized(
+        path=path, stats=stats, node=request.node
+    )
+    return path
+
+
+@pytest.fixture
+def datafiles(request, tmp_path: Path, tmp_path_factory) -> Iterator[Path]:
+    """
+    pytest fixture to define a 'tmp_path' containing files or directories
+    specified with a 'datafiles' mark.
+    """
+    start = time.perf_counter()
+    marks = _get_marks(request)
+    options = marks.options
+
+    state = request.config.pluginmanager.get_plugin("datafiles_state")
+    lazy_files = None
+    directory = tmp_path
+    ram_directory = None
+    claimed = state.claim(request.node.nodeid, tmp_path)
+    if claimed is not None:  # handed over from the previous test or prefetched
+        plan, stats = claimed
+        state.record_stats(request.node, stats)
+    else:
+        basetemp = tmp_path_factory.getbasetemp()
+        all_entries, copy_mode = state.prepare_all(marks, basetemp)
+        stats = {"copy_mode": copy_mode}
+        state.record_stats(request.node, stats)
+        plan = _plan_marks(all_entries, tmp_path, options)
+        if options["location"] == "ram":
+            ram_directory = state.ram_directory(request.node.name, plan)
+            if ram_directory is not None:
+                plan.rebase(str(tmp_path), str(ram_directory))
+                directory = ram_directory
+            stats["location"] = "tmp" if ram_directory is None else "ram"
+        copy_file = state.copy_function()
+        if options["lazy"]:
+            lazy_files = _LazyFiles(plan, copy_mode, copy_file)
+        else:
+            stats.update(_execute_plan(plan, copy_mode, state.workers, copy_file))
+    stats["duration"] = time.perf_counter() - start
+    if lazy_files is None:
+        path = _DatafilesPath._bind(directory, plan=plan)
+    else:
+        path = _LazyPath._bind(directory, plan=plan, lazy=lazy_files)
+    request.config.hook.pytest_datafiles_materialized(
+        path=path, stats=stats, node=request.node
+    )
+    sources = _source_state(plan) if options["detect_mutation"] else None
+    manifest = None
+    if (
+        lazy_files is None
+        and ram_directory is None
+        and request.node.nodeid in state.reusable
+    ):
+        manifest = _manifest(tmp_path)
+    yield path
+
+    handed_over = manifest is not None and state.hand_over(
+        marks, tmp_path, plan, manifest
+    )
+    if lazy_files is not None:
+        # the files copied during the test are part of the materialization
+        stats["duration"] += lazy_files.duration
+        stats["files"] = stats["materialized"] = lazy_files.materialized
+        stats["dirs"] = len(plan.dirs)
+        stats["symlinks"] = len(plan.symlinks)
+        stats["bytes"] = lazy_files.bytes
+        stats["allocated"] = lazy_files.allocated
+        stats["strategies"] = dict(lazy_files.strategies)
+        stats["pending"] = len(lazy_files.pending)
+    _DatafilesPath._unbind(directory)
+    if ram_directory is not None:
+        state.release_ram(ram_directory)
+    elif not handed_over:
+        state.retire(request.node.nodeid, tmp_path, plan)
+    if sources is not None:
+        changed = sorted(
+            source
+            for source, after in _source_state(plan).items()
+            if after != sources[source]
+        )
+        if changed:
+            pytest.fail(
+                "the test modified the datafiles sources: " + ", ".join(changed),
+                pytrace=False,
+            )
+
+
+@pytest.fixture(scope="module")
+def _datafiles_module_trees(request) -> Iterator[dict]:
+    """
+    The '_SharedTree's of the 'datafiles_module' fixture. Their snapshots
+    are unpinned at the end of the module.
+    """
+    trees: dict = {}
+    yield trees
+    state = request.config.pluginmanager.get_plugin("datafiles_state")
+    for tree in trees.values():
+        _DatafilesPath._unbind(tree.root)
+        state.unpin_snapshots(tree.pinned)
+
+
+@pytest.fixture(scope="session")
+def _datafiles_session_trees() -> Iterator[dict]:
+    """The '_SharedTree's of the 'datafiles_session' fixture."""
+    trees: dict = {}
+    yield trees
+    for tree in trees.values():
+        _DatafilesPath._unbind(tree.root)
+
+
+@pytest.fixture
+def datafiles_module(request, _datafiles_module_trees, tmp_path_factory) -> Path:
+    """
+    Like 'datafiles', but the directory is only copied once per module for
+    all tests with the same marks. Before every further test only what the
+    previous tests changed is restored.
+    """
+    return _shared_datafiles(
+        request, _datafiles_module_trees, "module", tmp_path_factory
+    )
+
+
+@pytest.fixture
+def datafiles_session(request, _datafiles_session_trees, tmp_path_factory) -> Path:
+    """
+    Like 'datafiles', but the directory is only copied once per session for
+    all tests with the same marks. Before every further test only what the
+    previous tests changed is restored.
+    """
+    return _shared_datafiles(
+        request, _datafiles_session_trees, "session", tmp_path_factory
+    )
@@ -0,0 +1,27 @@
+"""
+Smoke test of the benchmark suite.
+"""
+
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+BENCHMARK = Path(__file__).parent.parent.resolve() / "benchmarks" / "bench_datafiles.py"
+
+
+def test_benchmark_baseline(tmp_path):
+    """
+    Verify the benchmarks run and can be saved and compared to a baseline.
+    """
+    baseline = tmp_path / "baseline.json"
+    command = [sys.executable, str(BENCHMARK), "--scale", "0.001", "--repeat", "1"]
+    subprocess.run([*command, "--save", str(baseline)], check=True)
+    results = json.loads(baseline.read_text())["results"]
+    assert "huge_files-reflink-exception" in results
+    assert "duplicates-hardlink-overwrite" in results
+    assert results["duplicates-copy-ignore"]["bytes"] > 0
+
+    subprocess.run(
+        [*command, "--compare", str(baseline), "--tolerance", "1000"], check=True
+    )
@@ -2,11 +2,32 @@
 Tests for the pytest-datafiles pytest plugin
 """
 
+import bz2
+import gzip
+import json
+import lzma
 import os
+import pickle
+import subprocess
+import sys
+import tarfile
+import zipfile
 from pathlib import Path
 
 import pytest
 
+import pytest_datafiles
+from pytest_datafiles import (
+    _decompress_file,
+    _execute_plan,
+    _extract_archive,
+    _get_all_entries,
+    _parse_size,
+    _plan_copy,
+    datafiles_stats,
+    generated,
+)
+
 pytest_plugins = "pytester"  # pylint: disable=C0103
 
 
@@ -316,8 +337,11 @@ def test_non_existing_file(testdir):
             assert len(list(datafiles.iterdir())) == 1
     """)
     result = testdir.runpytest("-s")
+    result.assert_outcomes(errors=1)
     result.stdout.fnmatch_lines(
         [
+            "Invalid datafiles marks (the setup of these tests fails):",
+            "*::test_ode: FileNotFoundError:*fileZZ'",
             "E*FileNotFoundError:*fileZZ'",
         ]
     )
@@ -341,6 +365,7 @@ def test_invalid_keep_top_dir(testdir):
             assert True
     """)
     result = testdir.runpytest("-s")
+    result.assert_outcomes(errors=1)
     result.stdout.fnmatch_lines(
         [
             "E*ValueError: 'keep_top_dir' must be True or False*",
@@ -366,6 +391,7 @@ def test_invalid_on_duplicate(testdir):
             assert True
     """)
     result = testdir.runpytest("-s")
+    result.assert_outcomes(errors=1)
     result.stdout.fnmatch_lines(
         [
             "E*ValueError: 'on_duplicate' must be 'exception', 'ignore' or *",
@@ -423,3 +449,1638 @@ def test_file_mode_bits_preserved(datafiles):
         f"File permissions not preserved: "
         f"original={oct(original_mode)}, copied={oct(copied_mode)}"
     )
+
+
+@pytest.mark.datafiles(
+    FIXTURE_DIR / "dir4",
+    FIXTURE_DIR / "executable.sh",
+    FIXTURE_DIR / "sparrow_link.jpg",
+    copy_mode="reflink",
+)
+def test_copy_mode_reflink(request, datafiles):
+    """
+    Verify copy_mode=reflink copies the content (falling back to a regular
+    copy if the filesystem doesn't support cloning) and reports the strategy.
+    """
+    assert (datafiles / "subdir1" / "file1").read_bytes() == (
+        FIXTURE_DIR / "dir4" / "subdir1" / "file1"
+    ).read_bytes()
+    assert (datafiles / "executable.sh").stat().st_mode == (
+        FIXTURE_DIR / "executable.sh"
+    ).stat().st_mode
+    assert (datafiles / "sparrow_link.jpg").is_symlink()
+    stats = datafiles_stats(request.node)[0]
+    assert stats["copy_mode"] == "reflink"
+    assert sum(stats["strategies"].values()) == 5
+    assert set(stats["strategies"]) <= {"reflink", "copy_file_range", "copy"}
+
+
+def test_copy_mode_ini(testdir):
+    """
+    Verify the default copy_mode can be set with the 'datafiles_copy_mode' ini
+    option and that invalid values are rejected (when the test is selected).
+    """
+    testdir.makeini("""
+        [pytest]
+        datafiles_copy_mode = reflink
+    """)
+    testdir.makepyfile(f"""
+        import pytest
+        from pathlib import Path
+        from pytest_datafiles import datafiles_stats
+
+        FIXTURE_DIR = Path('{FIXTURE_DIR}')
+
+        @pytest.mark.datafiles(FIXTURE_DIR / 'huckleberry.txt')
+        def test_ini(request, datafiles):
+            stats = datafiles_stats(request.node)[0]
+            assert stats['copy_mode'] == 'reflink'
+
+        @pytest.mark.datafiles(
+            FIXTURE_DIR / 'huckleberry.txt',
+            copy_mode='invalid-value',
+            )
+        def test_invalid_param(datafiles):
+            assert True
+    """)
+    result = testdir.runpytest("-s")
+    result.assert_outcomes(passed=1, errors=1)
+    result.stdout.fnmatch_lines(["E*ValueError: 'copy_mode' must be one of*"])
+    # deselected tests are not validated
+    result = testdir.runpytest("-s", "-k", "test_ini")
+    result.assert_outcomes(passed=1)
+
+
+def test_copy_mode_hardlink(testdir, tmp_path):
+    """
+    Verify copy_mode=hardlink links the files to private copies of the
+    sources and protects them from being modified, leaving the permissions
+    of the sources alone.
+    """
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "sub").mkdir()
+    (source / "sub" / "file1").write_text("content")
+    os.symlink("sub/file1", str(source / "link"))
+    testdir.makepyfile(f"""
+        import os
+        import pytest
+        from pathlib import Path
+        from pytest_datafiles import datafiles_stats
+
+        SOURCE = Path({str(source)!r})
+
+        @pytest.mark.parametrize('run', [1, 2])
+        @pytest.mark.datafiles(SOURCE, copy_mode='hardlink')
+        def test_hardlink(request, datafiles, run):
+            linked = datafiles / 'sub' / 'file1'
+            assert linked.read_text() == 'content'
+            assert (datafiles / 'link').is_symlink()
+            assert not os.path.samefile(linked, SOURCE / 'sub' / 'file1')
+            stats = datafiles_stats(request.node)[0]
+            if stats['strategies'] == {{'hardlink': 1}}:
+                # linked to the same private copy by both tests
+                assert linked.stat().st_nlink == 1 + run
+                # root ignores the permission bits
+                assert not os.access(linked, os.W_OK) or os.geteuid() == 0
+                assert not linked.stat().st_mode & 0o222
+            else:
+                assert stats['strategies'] == {{'copy': 1}}
+    """)
+    mode = (source / "sub" / "file1").stat().st_mode
+    result = testdir.runpytest("-s", "-p", "no:randomly", "--datafiles-retain=all")
+    result.assert_outcomes(passed=2)
+    assert (source / "sub" / "file1").stat().st_mode == mode
+
+
+def test_copy_mode_none(testdir, tmp_path):
+    """
+    Verify copy_mode=none links to the sources instead of copying them, that
+    'mmap' maps the sources (unless the file was copied) and that
+    detect_mutation fails tests modifying them.
+    """
+    source = tmp_path / "source"
+    (source / "sub").mkdir(parents=True)
+    (source / "sub" / "file1").write_text("content")
+    (source / "file2").write_text("other")
+    testdir.makepyfile(f"""
+        import os
+        import pytest
+        from pathlib import Path
+        from pytest_datafiles import datafiles_stats
+
+        SOURCE = Path({str(source)!r})
+
+        @pytest.mark.datafiles(SOURCE, copy_mode='none')
+        def test_none(request, datafiles):
+            linked = datafiles / 'sub' / 'file1'
+            assert linked.is_symlink()
+            assert os.readlink(linked) == str(SOURCE / 'sub' / 'file1')
+            assert linked.read_text() == 'content'
+            stats = datafiles_stats(request.node)[0]
+            assert stats['strategies'] == {{'symlink': 2}}
+            with datafiles.mmap('sub/file1') as mapped:
+                assert mapped[:] == b'content'
+            with (datafiles / 'sub').mmap('file1') as mapped:
+                assert mapped[:] == b'content'
+
+        @pytest.mark.datafiles(SOURCE, lazy=True)
+        def test_mmap_lazy(datafiles):
+            with datafiles.mmap('file2') as mapped:
+                assert mapped.read() == b'other'
+                with pytest.raises(TypeError):
+                    mapped[0] = 0
+            assert datafiles.materialized == 0
+            (datafiles / 'file2').write_text('modified')
+            with datafiles.mmap('file2') as mapped:
+                assert mapped.read() == b'modified'
+
+        @pytest.mark.datafiles(SOURCE)
+        def test_mmap_copy(datafiles):
+            (datafiles / 'sub' / 'file1').write_text('modified')
+            with datafiles.mmap('sub/file1') as mapped:
+                assert mapped.read() == b'modified'
+
+        @pytest.mark.datafiles(SOURCE, copy_mode='none', detect_mutation=True)
+        def test_mutation(datafiles):
+            (datafiles / 'file2').write_text('changed')
+
+        @pytest.mark.datafiles(SOURCE, detect_mutation=True)
+        def test_no_mutation(datafiles):
+            (datafiles / 'file2').write_text('changed in the copy')
+    """)
+    result = testdir.runpytest("-p", "no:randomly")
+    result.assert_outcomes(passed=5, errors=1)
+    result.stdout.fnmatch_lines(
+        [
+            "*ERROR at teardown of test_mutation*",
+            f"*the test modified the datafiles sources: {source / 'file2'}",
+        ]
+    )
+
+
+def test_generated(testdir, tmp_path):
+    """
+    Verify generated entries are generated once per session (or once for all
+    runs with the persistent store) for every key and copied like a
+    directory.
+    """
+    log = tmp_path / "calls"
+    testdir.makepyfile(f"""
+        import pytest
+        from pytest_datafiles import generated
+
+        def make_records(directory, count=2):
+            with open('{log}', 'a') as log:
+                log.write(directory.name + str(count) + '\\n')
+            for i in range(count):
+                (directory / f'record{{i}}').write_text(str(i))
+
+        RECORDS = generated('records', make_records, key=2)
+
+        @pytest.mark.datafiles(RECORDS)
+        def test_content(datafiles):
+            assert sorted(p.name for p in datafiles.iterdir()) == [
+                'record0', 'record1'
+            ]
+
+        @pytest.mark.datafiles(
+            generated('records', make_records, key=2), keep_top_dir=True
+        )
+        def test_keep_top_dir(datafiles):
+            assert (datafiles / 'records' / 'record1').read_text() == '1'
+
+        @pytest.mark.datafiles(
+            generated('records', lambda d: make_records(d, 3), key=3)
+        )
+        def test_other_key(datafiles):
+            assert len(list(datafiles.iterdir())) == 3
+    """)
+    result = testdir.runpytest()
+    result.assert_outcomes(passed=3)
+    assert sorted(log.read_text().split()) == ["records2", "records3"]
+
+    log.unlink()
+    result = testdir.runpytest("--datafiles-persist-size=1M")
+    result.assert_outcomes(passed=3)
+    assert sorted(log.read_text().split()) == ["records2", "records3"]
+    log.unlink()
+    result = testdir.runpytest("--datafiles-persist-size=1M")
+    result.assert_outcomes(passed=3)
+    assert not log.exists()
+
+    assert generated("a", print, key=1) == generated("a", print, key=1)
+    assert generated("a", print, key=1) != generated("a", print, key=2)
+    with pytest.raises(ValueError, match="plain name"):
+        generated("a/b", print)
+
+
+def test_generated_key_stable(tmp_path):
+    """
+    Verify the cache key of a generated entry is the same in every process,
+    also for factories containing nested code and sets.
+    """
+    (tmp_path / "factories.py").write_text(
+        "from pytest_datafiles import generated\n"
+        "\n"
+        "def make(directory):\n"
+        "    names = [f'file{i}' for i in range(3) if i in {0, 1, 2}]\n"
+        "    def write(name):\n"
+        "        (directory / name).write_text(name)\n"
+        "    list(map(lambda name: write(name), names))\n"
+        "\n"
+        "print(generated('data', make).cache_key)\n"
+    )
+    keys = {
+        subprocess.run(
+            [sys.executable, "factories.py"],
+            cwd=tmp_path,
+            env={**os.environ, "PYTHONHASHSEED": seed},
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        for seed in ("1", "2")
+    }
+    assert len(keys) == 1
+
+
+def test_datafiles_parametrize(testdir, tmp_path):
+    """
+    Verify datafiles_parametrize creates a test item per matching file whose
+    datafiles only contain the file and the companions.
+    """
+    samples = tmp_path / "samples"
+    (samples / "sub").mkdir(parents=True)
+    for name in ("a.bin", "b.bin", "sub/c.bin", "schema.json", "readme.txt"):
+        (samples / name).write_text(name)
+    testdir.makepyfile(f"""
+        import pytest
+        from pytest_datafiles import datafiles_parametrize
+
+        @datafiles_parametrize(
+            '{samples}', '**/*.bin', companions=['schema.json'], copy_mode='none'
+        )
+        def test_sample(request, datafiles, datafile):
+            assert sorted(p.name for p in datafiles.iterdir()) == sorted(
+                [datafile, 'schema.json']
+            )
+            assert request.node.callspec.id.endswith((datafiles / datafile).read_text())
+            assert (datafiles / datafile).is_symlink()
+
+        @datafiles_parametrize('{samples}', argname='sample')
+        def test_argname(datafiles, sample):
+            assert [p.name for p in datafiles.iterdir()] == [sample]
+    """)
+    result = testdir.runpytest("-v")
+    result.assert_outcomes(passed=7)
+    result.stdout.fnmatch_lines_random(
+        [
+            "*test_sample?a.bin? PASSED*",
+            "*test_sample?b.bin? PASSED*",
+            "*test_sample?sub/c.bin? PASSED*",
+            "*test_argname?schema.json? PASSED*",
+        ]
+    )
+
+
+@pytest.mark.parametrize("copy_mode", ["copy", "reflink"])
+def test_sparse_files(tmp_path, copy_mode):
+    """
+    Verify the holes of sparse files are preserved and the allocated bytes
+    are reported next to the apparent size.
+    """
+    source = tmp_path / "source"
+    source.mkdir()
+    size = 64 * 1024**2
+    with open(source / "image", "wb") as image:
+        image.write(b"head")
+        image.seek(size // 2)
+        image.write(b"middle")
+        image.truncate(size)
+    allocated = os.stat(source / "image").st_blocks * 512
+    if not hasattr(os, "SEEK_DATA") or allocated >= size:
+        pytest.skip("the filesystem doesn't support sparse files")
+    target = tmp_path / "target"
+    target.mkdir()
+    stats = _execute_plan(
+        _plan_copy([source / "image"], target, "exception"), copy_mode
+    )
+    assert stats["bytes"] == size
+    assert stats["allocated"] == allocated
+    assert set(stats["strategies"]) <= {"sparse", "reflink"}
+    copy = target / "image"
+    assert copy.stat().st_size == size
+    assert copy.stat().st_blocks * 512 < size
+    with open(copy, "rb") as image:
+        assert image.read(4) == b"head"
+        image.seek(size // 2 - 2)
+        assert image.read(10) == b"\0\0middle\0\0"
+
+
+def test_snapshot_cache(testdir, tmp_path):
+    """
+    Verify that with a cache size every source is snapshotted once per
+    session, that modified sources get a new snapshot and that the least
+    recently used snapshots are evicted when the budget is exceeded.
+    """
+    for name in ("big", "small"):
+        (tmp_path / name).mkdir()
+    (tmp_path / "big" / "data").write_bytes(b"x" * 1000)
+    (tmp_path / "small" / "data").write_bytes(b"y" * 100)
+    testdir.makepyfile(f"""
+        import pytest
+        from pathlib import Path
+
+        SOURCE = Path({str(tmp_path)!r})
+
+        @pytest.fixture
+        def snapshots(tmp_path_factory):
+            root = tmp_path_factory.getbasetemp()
+            return lambda: sorted(p.name for p in root.glob('datafiles-cache/*/*'))
+
+        @pytest.mark.datafiles(SOURCE / 'big')
+        def test_1(snapshots, datafiles):
+            assert (datafiles / 'data').stat().st_size == 1000
+            assert snapshots() == ['big']
+
+        @pytest.mark.datafiles(SOURCE / 'big')
+        def test_2(snapshots, datafiles):
+            (datafiles / 'data').write_text('modified')
+            assert snapshots() == ['big']
+
+        @pytest.mark.datafiles(SOURCE / 'big', keep_top_dir=True)
+        def test_3(snapshots, datafiles):
+            assert (datafiles / 'big' / 'data').stat().st_size == 1000
+            assert snapshots() == ['big']
+            (SOURCE / 'big' / 'new').write_text('new')
+
+        @pytest.mark.datafiles(SOURCE / 'big')
+        def test_4(snapshots, datafiles):
+            assert (datafiles / 'new').is_file()
+            # the snapshot of the unmodified 'big' was evicted
+            assert snapshots() == ['big']
+
+        @pytest.mark.datafiles(SOURCE / 'small', SOURCE / 'big', keep_top_dir=True)
+        def test_5(snapshots, datafiles):
+            assert snapshots() == ['big', 'small']
+    """)
+    result = testdir.runpytest("--datafiles-cache-size=1200")
+    result.assert_outcomes(passed=5)
+
+
+@pytest.mark.parametrize("scope", ["module", "session"])
+def test_snapshot_cache_shared_tree(testdir, tmp_path, scope):
+    """
+    Verify the snapshots a shared tree restores files from are not evicted
+    while the tree is in use.
+    """
+    for name in ("a", "b"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "f").write_bytes(b"x" * 800)
+    testdir.makepyfile(f"""
+        import pytest
+        from pathlib import Path
+        from pytest_datafiles import datafiles_stats
+
+        SOURCE = Path({str(tmp_path)!r})
+
+        @pytest.mark.datafiles(SOURCE / 'a')
+        def test_1(datafiles_{scope}):
+            (datafiles_{scope} / 'f').write_text('modified')
+
+        @pytest.mark.datafiles(SOURCE / 'b')
+        def test_2(datafiles):
+            assert (datafiles / 'f').stat().st_size == 800
+
+        @pytest.mark.datafiles(SOURCE / 'a')
+        def test_3(request, datafiles_{scope}):
+            assert (datafiles_{scope} / 'f').stat().st_size == 800
+            stats = datafiles_stats(request.node)[0]
+            assert stats['restored'] == 1
+    """)
+    result = testdir.runpytest("-p", "no:randomly", "--datafiles-cache-size=1000")
+    result.assert_outcomes(passed=3)
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [("0", 0), ("1024", 1024), ("2k", 2048), ("1.5M", 1536 * 1024), ("1GB", 1024**3)],
+)
+def test_parse_size(value, expected):
+    """
+    Verify sizes with units are understood.
+    """
+    assert _parse_size(value) == expected
+
+
+def test_parse_size_invalid():
+    """
+    Verify ValueError is raised for an invalid size.
+    """
+    with pytest.raises(ValueError, match="Invalid size"):
+        _parse_size("lots")
+
+
+@pytest.mark.parametrize(
+    ("option", "name"),
+    [
+        ("--datafiles-cache-size=lots", "datafiles cache size"),
+        ("--datafiles-ram-size=-1", "datafiles ram size"),
+        ("-odatafiles_persist_size=nan", "datafiles persist size"),
+    ],
+)
+def test_invalid_size_option(testdir, option, name):
+    """
+    Verify an invalid size option is a usage error naming the option.
+    """
+    testdir.makepyfile("def test_nothing(): pass")
+    result = testdir.runpytest(option)
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+    result.stderr.fnmatch_lines([f"*{name} must be a size like 512M or 2G, got*"])
+
+
+def _tree(root):
+    """Returns the content of the directory 'root' for comparisons."""
+    result = {}
+    for path in sorted(root.rglob("*")):
+        if path.is_symlink():
+            content = os.readlink(path)
+        elif path.is_dir():
+            content = None
+        else:
+            content = path.read_bytes()
+        result[path.relative_to(root)] = (content, path.lstat().st_mode)
+    return result
+
+
+@pytest.mark.parametrize("on_duplicate", ["ignore", "overwrite"])
+@pytest.mark.parametrize("keep_top_dir", [True, False])
+def test_execute_plan_parallel(tmp_path, on_duplicate, keep_top_dir):
+    """
+    Verify copying with several workers yields exactly the same result as
+    copying sequentially.
+    """
+    entries = _get_all_entries(
+        [
+            FIXTURE_DIR / "dir1",
+            FIXTURE_DIR / "dir3",
+            FIXTURE_DIR / "dir6",
+            FIXTURE_DIR / "dir1" / "file1",
+            FIXTURE_DIR / "sparrow_link.jpg",
+            FIXTURE_DIR / "executable.sh",
+        ],
+        keep_top_dir,
+    )
+    (tmp_path / "serial").mkdir()
+    (tmp_path / "parallel").mkdir()
+    serial = _execute_plan(
+        _plan_copy(entries, tmp_path / "serial", on_duplicate), "copy", 1
+    )
+    parallel = _execute_plan(
+        _plan_copy(entries, tmp_path / "parallel", on_duplicate), "copy", 4
+    )
+    assert serial["strategies"] == parallel["strategies"]
+    assert _tree(tmp_path / "serial") == _tree(tmp_path / "parallel")
+
+
+def test_plan_duplicate_exception(tmp_path):
+    """
+    Verify duplicates raise a ValueError while planning, before anything is
+    copied.
+    """
+    entries = _get_all_entries([FIXTURE_DIR / "dir1", FIXTURE_DIR / "dir3"], False)
+    with pytest.raises(ValueError, match="file1' already exists"):
+        _plan_copy(entries, tmp_path, "exception")
+    assert not list(tmp_path.iterdir())
+
+
+def test_invalid_workers(testdir):
+    """
+    Verify an invalid number of workers is a usage error.
+    """
+    testdir.makepyfile("def test_nothing(): pass")
+    result = testdir.runpytest("--datafiles-workers=none")
+    result.stderr.fnmatch_lines(["*datafiles workers must be a positive number*"])
+
+
+@pytest.mark.datafiles(
+    FIXTURE_DIR / "dir1",
+    FIXTURE_DIR / "dir4",
+    FIXTURE_FILES[0],  # huckleberry.txt
+    lazy=True,
+)
+def test_lazy(datafiles):
+    """
+    Verify that with lazy=True only the directories are created up front and
+    files are copied when they are accessed.
+    """
+    assert datafiles.materialized == 0
+    assert (datafiles / "subdir1").is_dir()
+    assert "Mark Twain" in (datafiles / "huckleberry.txt").read_text("utf-8")
+    assert datafiles.materialized == 1
+    # listing a directory copies the files in it (but not in subdirectories)
+    assert sorted(p.name for p in (datafiles / "subdir2").iterdir()) == [
+        "file1",
+        "file2",
+    ]
+    assert datafiles.materialized == 3
+    with open(datafiles / "file1") as file1:
+        assert file1.read() == "dir1\n123\n"
+    assert datafiles.materialized == 4
+    assert len(list(datafiles.iterdir())) == 6
+    assert datafiles.materialized == 6
+    assert len(list(datafiles.rglob("*"))) == 10
+    assert datafiles.materialized == 8
+
+
+@pytest.mark.datafiles(FIXTURE_DIR / "dir6", lazy=True)
+def test_lazy_symlink(datafiles):
+    """
+    Verify that symlinks are created right away with lazy=True.
+    """
+    assert (datafiles / "sparrow_link.jpg").is_symlink()
+    assert datafiles.materialized == 0
+
+
+def test_lazy_report(testdir):
+    """
+    Verify the number of materialized and pending files is recorded.
+    """
+    testdir.makeconftest("""
+        import json
+
+        def pytest_runtest_logreport(report):
+            if report.when == 'teardown':
+                stats = report.datafiles[0]
+                print('DATAFILES', json.dumps(stats, sort_keys=True))
+    """)
+    testdir.makepyfile(f"""
+        import pytest
+        from pathlib import Path
+
+        FIXTURE_DIR = Path('{FIXTURE_DIR}')
+
+        @pytest.mark.datafiles(FIXTURE_DIR / 'dir1', lazy=True)
+        def test_lazy(datafiles):
+            (datafiles / 'file2').read_text()
+    """)
+    result = testdir.runpytest("-s")
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines(
+        [
+            '*DATAFILES {"allocated": *, "bytes": 9, "copy_mode": "copy", "dirs": 0, "duration": *, '
+            '"files": 1, "materialized": 1, "pending": 2, "strategies": {"copy": 1}, '
+            '"symlinks": 0}'
+        ]
+    )
+
+
+def test_report(testdir, tmp_path):
+    """
+    Verify --datafiles-report shows the slowest and largest setups and
+    --datafiles-report-json exports the statistics of all setups.
+    """
+    (tmp_path / "big").write_bytes(b"x" * 4096)
+    (tmp_path / "small").write_bytes(b"x")
+    testdir.makepyfile(f"""
+        import pytest
+
+        @pytest.mark.datafiles('{tmp_path / "big"}')
+        def test_big(datafiles):
+            pass
+
+        @pytest.mark.datafiles('{tmp_path / "small"}')
+        def test_small(datafiles_module):
+            pass
+
+        def test_none():
+            pass
+    """)
+    report_path = tmp_path / "report.json"
+    result = testdir.runpytest(
+        "--datafiles-report=1", f"--datafiles-report-json={report_path}"
+    )
+    result.assert_outcomes(passed=3)
+    result.stdout.fnmatch_lines(
+        [
+            "*= datafiles report =*",
+            "2 setups: *s, 2 files, 0 dirs, 4.0 KiB (* allocated)",
+            "slowest datafiles setups:",
+            "*s       1 files * copy * test_report.py::test_*",
+            "largest datafiles setups:",
+            "*s       1 files    4.0 KiB copy * test_report.py::test_big",
+        ]
+    )
+    report = json.loads(report_path.read_text())
+    assert report["totals"]["setups"] == 2
+    assert report["totals"]["bytes"] == 4097
+    setups = {setup["nodeid"]: setup for setup in report["setups"]}
+    assert setups["test_report.py::test_big"]["strategies"] == {"copy": 1}
+    assert setups["test_report.py::test_small"]["scope"] == "module"
+    assert setups["test_report.py::test_small"]["duration"] >= 0
+    # the statistics reach the pytest-xdist controller with the reports
+    pytest.importorskip("xdist")
+    result = testdir.runpytest("-n", "2", f"--datafiles-report-json={report_path}")
+    result.assert_outcomes(passed=3)
+    assert json.loads(report_path.read_text())["totals"]["setups"] == 2
+
+
+def test_invalid_report(testdir):
+    """
+    Verify a negative number of setups to report is a usage error.
+    """
+    testdir.makepyfile("def test_nothing(): pass")
+    result = testdir.runpytest("--datafiles-report=-1")
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+    result.stderr.fnmatch_lines(["*datafiles report must be a positive number or 0*"])
+
+
+def test_stats_user_properties(testdir, tmp_path):
+    """
+    Verify the statistics are only recorded in the user_properties (and the
+    JUnit XML) with --datafiles-user-properties.
+    """
+    testdir.makepyfile(f"""
+        import pytest
+        from pytest_datafiles import datafiles_stats
+
+        @pytest.mark.datafiles('{FIXTURE_FILES[0]}')
+        def test_stats(request, datafiles):
+            assert datafiles_stats(request.node)[0]['files'] == 1
+            print('PROPERTIES', [name for name, _ in request.node.user_properties])
+    """)
+    result = testdir.runpytest("-s", f"--junitxml={tmp_path / 'default.xml'}")
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines(["*PROPERTIES [[][]]"])
+    assert 'name="datafiles"' not in (tmp_path / "default.xml").read_text()
+    result = testdir.runpytest(
+        "-s", "--datafiles-user-properties", f"--junitxml={tmp_path / 'opt_in.xml'}"
+    )
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines(["*PROPERTIES [[]'datafiles'[]]"])
+    assert 'name="datafiles"' in (tmp_path / "opt_in.xml").read_text()
+
+
+def test_hooks(testdir):
+    """
+    Verify the resolved entries and the copy can be changed by plugins and
+    the materialization is reported to them.
+    """
+    testdir.makeconftest("""
+        import shutil
+
+        def pytest_datafiles_resolve(entries, options):
+            return [entry for entry in entries if entry.name != 'huckleberry.txt']
+
+        def pytest_datafiles_copy(source, target, copy_mode, copy_metadata):
+            if source.endswith('file2'):
+                shutil.copyfile(source, target)
+                return 'custom'
+            return None
+
+        def pytest_datafiles_materialized(path, stats, node):
+            print('MATERIALIZED', node.name, path.name, sorted(stats['strategies'].items()))
+    """)
+    testdir.makepyfile(f"""
+        import pytest
+        from pathlib import Path
+
+        FIXTURE_DIR = Path('{FIXTURE_DIR}')
+
+        @pytest.mark.datafiles(
+            FIXTURE_DIR / 'huckleberry.txt',
+            FIXTURE_DIR / 'dir1',
+            keep_top_dir=True,
+        )
+        def test_hooks(datafiles):
+            assert sorted(p.name for p in datafiles.iterdir()) == ['dir1']
+    """)
+    result = testdir.runpytest("-s")
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines(
+        ["*MATERIALIZED test_hooks test_hooks0 [[]('copy', 2), ('custom', 1)]"]
+    )
+
+
+def _make_archives(path):
+    """
+    Creates the archives 'corpus.tar.gz' and 'corpus.zip' in 'path', both
+    containing 'file1' and 'sub/file2', and returns their paths.
+    """
+    content = path / "content"
+    (content / "sub").mkdir(parents=True)
+    (content / "file1").write_text("file1")
+    (content / "sub" / "file2").write_text("file2")
+    with tarfile.open(path / "corpus.tar.gz", "w:gz") as tar:
+        tar.add(content / "file1", "file1")
+        tar.add(content / "sub", "sub")
+    with zipfile.ZipFile(path / "corpus.zip", "w") as zip_file:
+        zip_file.write(content / "file1", "file1")
+        zip_file.write(content / "sub" / "file2", "sub/file2")
+    return path / "corpus.tar.gz", path / "corpus.zip"
+
+
+@pytest.mark.parametrize("archive", [0, 1], ids=["tar.gz", "zip"])
+def test_extract(testdir, tmp_path, archive):
+    """
+    Verify archives are extracted with extract=True (honoring keep_top_dir)
+    and only once per session.
+    """
+    archive = _make_archives(tmp_path)[archive]
+    testdir.makepyfile(f"""
+        import pytest
+        from pathlib import Path
+
+        ARCHIVE = Path({str(archive)!r})
+
+        @pytest.mark.datafiles(ARCHIVE, extract=True)
+        def test_extract(datafiles):
+            assert sorted(p.name for p in datafiles.iterdir()) == ['file1', 'sub']
+            assert (datafiles / 'sub' / 'file2').read_text() == 'file2'
+            (datafiles / 'file1').write_text('modified')
+
+        @pytest.mark.datafiles(ARCHIVE, extract=True, keep_top_dir=True)
+        def test_extract_keep_top_dir(datafiles, tmp_path_factory):
+            assert (datafiles / 'corpus' / 'file1').read_text() == 'file1'
+            root = tmp_path_factory.getbasetemp() / 'datafiles-archives'
+            assert len(list(root.iterdir())) == 1
+
+        @pytest.mark.datafiles(ARCHIVE)
+        def test_no_extract(datafiles):
+            assert (datafiles / ARCHIVE.name).is_file()
+    """)
+    result = testdir.runpytest()
+    result.assert_outcomes(passed=3)
+
+
+def test_extract_duplicate(testdir, tmp_path):
+    """
+    Verify extracted archives honor on_duplicate.
+    """
+    _make_archives(tmp_path)
+    testdir.makepyfile(f"""
+        import pytest
+        from pathlib import Path
+
+        SOURCE = Path({str(tmp_path)!r})
+
+        @pytest.mark.datafiles(
+            SOURCE / 'corpus.zip',
+            SOURCE / 'content' / 'file1',
+            extract=True,
+            )
+        def test_duplicate(datafiles):
+            assert True
+    """)
+    result = testdir.runpytest()
+    result.stdout.fnmatch_lines(["E*ValueError:*file1'*already exists*"])
+
+
+def test_extract_zstd(tmp_path):
+    """
+    Verify zstd compressed tar archives can be extracted.
+    """
+    zstandard = pytest.importorskip("zstandard")
+    with tarfile.open(tmp_path / "plain.tar", "w") as tar:
+        tar.add(FIXTURE_FILES[0], "huckleberry.txt")
+    with open(tmp_path / "plain.tar", "rb") as src, open(
+        tmp_path / "corpus.tar.zst", "wb"
+    ) as dst:
+        zstandard.ZstdCompressor().copy_stream(src, dst)
+    target = tmp_path / "extracted"
+    target.mkdir()
+    _extract_archive(tmp_path / "corpus.tar.zst", target)
+    assert "Mark Twain" in (target / "huckleberry.txt").read_text("utf-8")
+
+
+@pytest.mark.parametrize("data_filter", [True, False], ids=["filter", "no_filter"])
+@pytest.mark.parametrize(
+    ("member", "linkname"),
+    [
+        ("../escaped", None),
+        ("{outside}/escaped", None),
+        ("link", ".."),
+        ("link", "{outside}"),
+    ],
+)
+def test_extract_outside(tmp_path, monkeypatch, data_filter, member, linkname):
+    """
+    Verify members of tar archives are never extracted (or written through
+    symlinks) outside of the target directory, also without extraction
+    filters.
+    """
+    if not data_filter:
+        monkeypatch.delattr(tarfile, "data_filter", raising=False)
+    elif not hasattr(tarfile, "data_filter"):
+        pytest.skip("tarfile has no extraction filters")
+    outside = tmp_path / "extract"
+    with tarfile.open(tmp_path / "evil.tar", "w") as tar:
+        info = tarfile.TarInfo(member.format(outside=outside))
+        if linkname is not None:
+            info.type = tarfile.SYMTYPE
+            info.linkname = linkname.format(outside=outside)
+            tar.addfile(info)
+            # written through the symlink if it was extracted
+            tar.addfile(tarfile.TarInfo("link/escaped"))
+        else:
+            tar.addfile(info)
+    target = outside / "target"
+    target.mkdir(parents=True)
+    try:
+        _extract_archive(tmp_path / "evil.tar", target)
+    except (ValueError, tarfile.TarError):
+        pass
+    assert os.listdir(outside) == ["target"]
+
+
+def test_decompress(testdir, tmp_path):
+    """
+    Verify decompress=True decompresses the marked compressed files once per
+    session and uses them without the suffix.
+    """
+    content = FIXTURE_FILES[0].read_bytes()
+    source = tmp_path / "source"
+    source.mkdir()
+    for suffix, module in ((".gz", gzip), (".bz2", bz2), (".xz", lzma)):
+        with module.open(source / f"golden{suffix}", "wb") as compressed:
+            compressed.write(content)
+    with gzip.open(source / "other.csv.gz", "wb") as compressed:
+        compressed.write(b"a,b")
+    testdir.makepyfile(f"""
+        import os
+        import pytest
+        from pathlib import Path
+
+        SOURCE = Path('{source}')
+        CONTENT = Path('{FIXTURE_FILES[0]}').read_bytes()
+
+        @pytest.mark.datafiles(
+            SOURCE / 'golden.gz', SOURCE / 'other.csv.gz', decompress=True
+        )
+        @pytest.mark.parametrize('number', range(2))
+        def test_gzip(datafiles, tmp_path_factory, number):
+            assert sorted(os.listdir(datafiles)) == ['golden', 'other.csv']
+            assert (datafiles / 'golden').read_bytes() == CONTENT
+            assert (datafiles / 'other.csv').read_text() == 'a,b'
+            root = tmp_path_factory.getbasetemp() / 'datafiles-decompressed'
+            assert len(os.listdir(root)) == 2
+
+        @pytest.mark.datafiles(SOURCE / 'golden.bz2', decompress=True)
+        def test_bz2(datafiles):
+            assert (datafiles / 'golden').read_bytes() == CONTENT
+
+        @pytest.mark.datafiles(SOURCE / 'golden.xz', decompress=True)
+        def test_xz(datafiles):
+            assert (datafiles / 'golden').read_bytes() == CONTENT
+
+        @pytest.mark.datafiles(SOURCE / 'golden.gz')
+        def test_compressed(datafiles):
+            assert os.listdir(datafiles) == ['golden.gz']
+
+        @pytest.mark.datafiles(SOURCE, decompress=True)
+        def test_directory(datafiles):
+            assert 'golden.gz' in os.listdir(datafiles)
+    """)
+    result = testdir.runpytest()
+    result.assert_outcomes(passed=6)
+
+
+def test_decompress_zstd(tmp_path):
+    """
+    Verify zstd compressed files can be decompressed.
+    """
+    zstandard = pytest.importorskip("zstandard")
+    (tmp_path / "data.csv.zst").write_bytes(zstandard.ZstdCompressor().compress(b"a,b"))
+    _decompress_file(tmp_path / "data.csv.zst", tmp_path / "data.csv")
+    assert (tmp_path / "data.csv").read_text() == "a,b"
+
+
+def test_persistent_store(testdir, tmp_path, monkeypatch):
+    """
+    Verify extracted archives are kept between runs in pytest's cache
+    directory, that the store can be cleared and that it is pruned to its size
+    limit.
+    """
+    extracted = []
+
+    def extract_archive(archive, target):
+        extracted.append(archive)
+        _extract_archive(archive, target)
+
+    monkeypatch.setattr(pytest_datafiles, "_extract_archive", extract_archive)
+    archive, _ = _make_archives(tmp_path)
+    testdir.makepyfile(f"""
+        import pytest
+
+        @pytest.mark.datafiles({str(archive)!r}, extract=True)
+        def test_extract(datafiles):
+            assert (datafiles / 'sub' / 'file2').read_text() == 'file2'
+    """)
+    store = testdir.tmpdir / ".pytest_cache" / "d" / "datafiles"
+
+    testdir.runpytest("--datafiles-persist-size=1M").assert_outcomes(passed=1)
+    testdir.runpytest("--datafiles-persist-size=1M").assert_outcomes(passed=1)
+    assert len(extracted) == 1
+    assert len(store.listdir()) == 1
+
+    testdir.runpytest(
+        "--datafiles-persist-size=1M", "--datafiles-cache-clear"
+    ).assert_outcomes(passed=1)
+    assert len(extracted) == 2
+
+    # the entry doesn't fit and is removed at the end of the session
+    testdir.runpytest("--datafiles-persist-size=1").assert_outcomes(passed=1)
+    assert not store.listdir()
+    testdir.runpytest("--datafiles-persist-size=1M").assert_outcomes(passed=1)
+    assert len(extracted) == 3
+
+
+def test_persistent_store_shared(testdir, tmp_path):
+    """
+    Verify the persistent store is shared by several processes (pytest-xdist
+    workers): entries created by another process are used, saving merges the
+    usage and only the pruning store removes entries.
+    """
+    config = testdir.parseconfigure()
+    first = pytest_datafiles._PersistentStore(config.cache, 1)
+    second = pytest_datafiles._PersistentStore(config.cache, 1)
+
+    def create(directory):
+        (directory / "file").write_text("content")
+
+    assert (second.get("a", "a", create) / "file").read_text() == "content"
+    assert (first.get("a", "a", create) / "file").read_text() == "content"
+    second.get("b", "b", create)
+    first.save(prune=False)
+    second.save(prune=False)
+    assert sorted(os.listdir(first.root)) == ["a", "b"]
+    # too big, only the most recently used entry is kept
+    pytest_datafiles._PersistentStore(config.cache, 10).save()
+    assert os.listdir(first.root) == ["b"]
+
+
+def test_datafiles_module(testdir):
+    """
+    Verify datafiles_module copies the files once per module and marks and
+    only restores what was changed before every further test.
+    """
+    testdir.makeconftest("""
+        import pytest
+        from pytest_datafiles import datafiles_stats
+
+        @pytest.fixture
+        def stats(request):
+            yield
+            stats = datafiles_stats(request.node)
+            print('STATS', request.node.name, stats)
+    """)
+    for module in ("test_a", "test_b"):
+        testdir.makepyfile(
+            **{
+                module: f"""
+        import os
+        import pytest
+        from pathlib import Path
+
+        FIXTURE_DIR = Path('{FIXTURE_DIR}')
+        pytestmark = pytest.mark.datafiles(FIXTURE_DIR / 'dir4')
+
+        def test_1(stats, datafiles_module, datafiles_session):
+            (datafiles_module / 'subdir1' / 'file1').write_text('modified')
+            (datafiles_module / 'subdir1' / 'file2').unlink()
+            (datafiles_module / 'subdir1' / 'new').mkdir()
+            (datafiles_module / 'subdir1' / 'new' / 'file').write_text('new')
+            os.chmod(datafiles_module / 'subdir2', 0o500)
+            (datafiles_session / 'subdir2').rename(datafiles_session / 'moved')
+
+        def test_2(stats, datafiles_module, datafiles_session):
+            for datafiles in (datafiles_module, datafiles_session):
+                assert sorted(
+                    str(p.relative_to(datafiles)) for p in datafiles.rglob('*')
+                ) == [
+                    'subdir1',
+                    'subdir1/file1',
+                    'subdir1/file2',
+                    'subdir2',
+                    'subdir2/file1',
+                    'subdir2/file2',
+                ]
+                assert (datafiles / 'subdir1' / 'file1').read_text() == (
+                    FIXTURE_DIR / 'dir4' / 'subdir1' / 'file1'
+                ).read_text()
+                assert os.access(datafiles / 'subdir2', os.W_OK)
+
+        @pytest.mark.datafiles(FIXTURE_DIR / 'huckleberry.txt')
+        def test_3(stats, datafiles_module):
+            assert len(list(datafiles_module.iterdir())) == 3
+    """
+            }
+        )
+    result = testdir.runpytest("-s", "-p", "no:randomly")
+    result.assert_outcomes(passed=6)
+    result.stdout.fnmatch_lines(
+        [
+            "*STATS test_1 [[]{*'module', 'files': 4, *}, {*'session', 'files': 4, *",
+            "*STATS test_2 [[]{*'module', 'restored': 3, *}, {*'session', 'restored': 3, *",
+            "*STATS test_3 [[]{*'scope': 'module', 'files': 5, *}*",
+            "*STATS test_1 [[]{*'module', 'files': 4, *}, {*'session', 'restored': 0, *",
+            "*STATS test_2 [[]{*'module', 'restored': 3, *}, {*'session', 'restored': 3, *",
+        ]
+    )
+
+
+@pytest.mark.datafiles(
+    FIXTURE_DIR / "dir4" / "subdir1",
+    FIXTURE_DIR / "dir5" / "subdir1",
+    keep_top_dir=True,
+    on_duplicate="overwrite",
+)
+def test_on_duplicate_overwrite_dir(datafiles):
+    """
+    Verify that a duplicate directory replaces the previous one completely.
+    """
+    assert [p.name for p in (datafiles / "subdir1").iterdir()] == ["file51"]
+
+
+@pytest.mark.datafiles(
+    FIXTURE_DIR / "dir1",
+    FIXTURE_DIR / "dir2",
+    FIXTURE_DIR / "dir3",
+    on_duplicate="overwrite",
+)
+def test_plan(datafiles):
+    """
+    Verify the plan lists every file once and the shadowed entries.
+    """
+    assert sorted(Path(target).name for target in datafiles.plan.files) == [
+        "file1",
+        "file2",
+        "file3",
+        "file4",
+        "file5",
+        "file6",
+    ]
+    assert datafiles.plan.files[str(datafiles / "file1")][0] == str(
+        FIXTURE_DIR / "dir3" / "file1"
+    )
+    assert sorted(datafiles.plan.shadowed) == [
+        (str(FIXTURE_DIR / "dir1" / "file1"), str(datafiles / "file1")),
+        (str(FIXTURE_DIR / "dir2" / "file4"), str(datafiles / "file4")),
+    ]
+    assert (datafiles / "sub").plan is datafiles.plan
+
+
+@pytest.mark.datafiles(FIXTURE_DIR / "dir1")
+def test_pickle(datafiles):
+    """
+    Verify the paths returned by the fixture can be pickled (e.g. to pass
+    them to another process) and are unpickled as plain paths.
+    """
+    for path in (datafiles, datafiles / "file1"):
+        unpickled = pickle.loads(pickle.dumps(path))
+        assert unpickled == path
+        assert type(unpickled) is type(Path())
+
+
+@pytest.mark.datafiles(FIXTURE_DIR / "dir1", lazy=True)
+def test_pickle_lazy(datafiles):
+    """
+    Verify pickling a lazy path copies the files it refers to first.
+    """
+    unpickled = pickle.loads(pickle.dumps(datafiles))
+    assert datafiles.materialized == len(datafiles.plan.files)
+    assert (unpickled / "file1").read_text() == "dir1\n123\n"
+
+
+def test_include_exclude(testdir, tmp_path):
+    """
+    Verify only included entries are copied and excluded directories are
+    not even walked, also below a marked symlink to a directory.
+    """
+    source = tmp_path / "source"
+    for name in ("a.json", "b.txt", ".git/config", "sub/c.json", "sub/d.bin"):
+        (source / name).parent.mkdir(parents=True, exist_ok=True)
+        (source / name).write_text(name)
+    (source / "empty").mkdir()
+    (tmp_path / "other").mkdir()
+    (tmp_path / "other" / "b.txt").write_text("other")
+    os.symlink(str(source), str(tmp_path / "link"))
+    testdir.makepyfile(f"""
+        import pytest
+        from pathlib import Path
+
+        SOURCE = Path('{source}')
+        LINK = Path('{tmp_path / "link"}')
+        seen = []
+
+        def is_git(path):
+            seen.append(path)
+            return path.name == '.git'
+
+        @pytest.mark.datafiles(SOURCE, include='*.json', exclude=is_git)
+        def test_include(datafiles):
+            assert sorted(
+                str(p.relative_to(datafiles)) for p in datafiles.rglob('*')
+            ) == ['a.json', 'sub', 'sub/c.json']
+            assert SOURCE / '.git' in seen
+            assert SOURCE / '.git' / 'config' not in seen
+
+        @pytest.mark.datafiles(
+            SOURCE,
+            '{tmp_path / "other"}',
+            exclude=['sub/*.bin', lambda path: path == SOURCE / 'b.txt'],
+        )
+        def test_exclude(datafiles):
+            assert (datafiles / 'b.txt').read_text() == 'other'
+            assert not (datafiles / 'sub' / 'd.bin').exists()
+            assert (datafiles / 'sub' / 'c.json').exists()
+            assert (datafiles / 'empty').is_dir()
+
+        @pytest.mark.datafiles(SOURCE, keep_top_dir=True, include='source/sub/*')
+        def test_keep_top_dir(datafiles):
+            assert sorted(
+                str(p.relative_to(datafiles)) for p in datafiles.rglob('*')
+            ) == ['source', 'source/sub', 'source/sub/c.json', 'source/sub/d.bin']
+
+        @pytest.mark.datafiles(LINK, keep_top_dir=True, include='*.json')
+        def test_symlinked_dir(datafiles):
+            assert sorted(
+                str(p.relative_to(datafiles)) for p in datafiles.rglob('*')
+            ) == ['link', 'link/a.json', 'link/sub', 'link/sub/c.json']
+    """)
+    result = testdir.runpytest()
+    result.assert_outcomes(passed=4)
+
+    testdir.makepyfile(
+        test_invalid=f"""
+        import pytest
+
+        @pytest.mark.datafiles('{source}', include=3)
+        def test_invalid(datafiles):
+            pass
+    """
+    )
+    result = testdir.runpytest("test_invalid.py")
+    result.assert_outcomes(errors=1)
+    result.stdout.fnmatch_lines(
+        ["E*ValueError: 'include' must be a glob pattern, a callable or a list*"]
+    )
+
+
+def test_plan_stats_once(tmp_path, monkeypatch):
+    """
+    Verify planning a tree stats every entry at most once: only the marked
+    entry is stat-ed explicitly, the entries below it come from 'os.scandir'.
+    """
+    calls = []
+    for name in ("stat", "lstat"):
+        function = getattr(os, name)
+        monkeypatch.setattr(
+            os,
+            name,
+            lambda path, *args, function=function, **kwargs: (
+                calls.append(str(path)) or function(path, *args, **kwargs)
+            ),
+        )
+    plan = _plan_copy([FIXTURE_DIR / "dir4"], tmp_path, "exception")
+    monkeypatch.undo()
+    assert calls == [str(FIXTURE_DIR / "dir4")]
+    assert len(plan.files) == 4
+    assert (
+        plan.files[str(tmp_path / "dir4" / "subdir1" / "file1")].size
+        == (FIXTURE_DIR / "dir4" / "subdir1" / "file1").stat().st_size
+    )
+
+
+@pytest.mark.parametrize("preserve_metadata", [True, False])
+def test_preserve_metadata(testdir, tmp_path, preserve_metadata):
+    """
+    Verify the permissions and times are only copied with
+    preserve_metadata=True.
+    """
+    source = tmp_path / "source"
+    (source / "sub").mkdir(parents=True)
+    (source / "sub" / "script.sh").write_text("#!/bin/sh")
+    os.chmod(source / "sub" / "script.sh", 0o755)
+    os.utime(source / "sub" / "script.sh", (1000000000, 1000000000))
+    testdir.makepyfile(f"""
+        import os
+        import pytest
+
+        @pytest.mark.datafiles('{source}', preserve_metadata={preserve_metadata})
+        def test_metadata(datafiles):
+            script = datafiles / 'sub' / 'script.sh'
+            assert script.read_text() == '#!/bin/sh'
+            assert os.access(script, os.X_OK) is {preserve_metadata}
+            assert (script.stat().st_mtime == 1000000000) is {preserve_metadata}
+    """)
+    result = testdir.runpytest()
+    result.assert_outcomes(passed=1)
+
+
+def test_prefetch(testdir):
+    """
+    Verify --datafiles-prefetch copies the datafiles of the next test in the
+    background and the test claims them, unless its 'tmp_path' isn't empty.
+    """
+    testdir.makeconftest("""
+        import pytest
+
+        def pytest_runtest_logreport(report):
+            if report.when == 'teardown':
+                for stats in report.datafiles:
+                    print('PREFETCHED', report.nodeid, stats.get('prefetched'))
+
+        @pytest.fixture
+        def dirty(tmp_path):
+            (tmp_path / 'dirty').write_text('dirty')
+    """)
+    testdir.makepyfile(f"""
+        import os
+        import pytest
+        from pathlib import Path
+
+        FIXTURE_DIR = Path('{FIXTURE_DIR}')
+        pytestmark = pytest.mark.datafiles(FIXTURE_DIR / 'dir4')
+
+        def check(datafiles, tmp_path):
+            assert datafiles == tmp_path
+            assert sorted(
+                str(p.relative_to(datafiles)) for p in datafiles.rglob('*')
+            ) == [
+                'subdir1',
+                'subdir1/file1',
+                'subdir1/file2',
+                'subdir2',
+                'subdir2/file1',
+                'subdir2/file2',
+            ]
+            assert str(datafiles / 'subdir1' / 'file1') in datafiles.plan.files
+
+        def test_1(datafiles, tmp_path):
+            check(datafiles, tmp_path)
+
+        def test_2(datafiles, tmp_path):
+            check(datafiles, tmp_path)
+
+        @pytest.mark.skip
+        def test_3(datafiles):
+            pass
+
+        def test_4(dirty, datafiles, tmp_path):
+            assert (datafiles / 'dirty').exists()
+            assert (datafiles / 'subdir2' / 'file2').exists()
+
+        def test_5(datafiles, tmp_path):
+            check(datafiles, tmp_path)
+            staging = tmp_path.parent / 'datafiles-prefetch'
+            assert os.listdir(staging) == []
+    """)
+    result = testdir.runpytest("-s", "-p", "no:randomly", "--datafiles-prefetch")
+    result.assert_outcomes(passed=4, skipped=1)
+    result.stdout.fnmatch_lines(
+        [
+            "*PREFETCHED test_prefetch.py::test_1 None",
+            "*PREFETCHED test_prefetch.py::test_2 True",
+            "*PREFETCHED test_prefetch.py::test_4 None",
+            "*PREFETCHED test_prefetch.py::test_5 True",
+        ]
+    )
+
+
+def test_group(testdir):
+    """
+    Verify --datafiles-group runs tests with the same marks one after the
+    other (within their module or class) and hands unchanged datafiles over
+    to the next test.
+    """
+    testdir.makeconftest("""
+        def pytest_runtest_logreport(report):
+            if report.when == 'teardown':
+                for stats in report.datafiles:
+                    print('REUSED', report.nodeid, stats.get('reused'))
+    """)
+    testdir.makepyfile(
+        test_a=f"""
+        import pytest
+        from pathlib import Path
+
+        FIXTURE_DIR = Path('{FIXTURE_DIR}')
+
+        @pytest.mark.datafiles(FIXTURE_DIR / 'dir1')
+        def test_1(datafiles):
+            assert (datafiles / 'file1').exists()
+
+        @pytest.mark.datafiles(FIXTURE_DIR / 'dir2')
+        def test_2(datafiles):
+            assert (datafiles / 'file4').exists()
+
+        @pytest.mark.datafiles(FIXTURE_DIR / 'dir1')
+        def test_3(datafiles, tmp_path):
+            assert datafiles == tmp_path
+            assert sorted(p.name for p in datafiles.iterdir()) == [
+                'file1', 'file2', 'file3'
+            ]
+            assert str(datafiles / 'file1') in datafiles.plan.files
+            (datafiles / 'file1').write_text('modified')
+    """,
+        test_b=f"""
+        import pytest
+        from pathlib import Path
+
+        FIXTURE_DIR = Path('{FIXTURE_DIR}')
+
+        def setup_module():
+            print('SETUP test_b')
+
+        @pytest.mark.datafiles(FIXTURE_DIR / 'dir1')
+        def test_4(datafiles):
+            assert (datafiles / 'file1').read_text() != 'modified'
+
+        @pytest.mark.datafiles(FIXTURE_DIR / 'dir2')
+        def test_5(datafiles):
+            assert (datafiles / 'file4').exists()
+
+        class TestClass:
+            @pytest.mark.datafiles(FIXTURE_DIR / 'dir2')
+            def test_6(self, datafiles):
+                assert (datafiles / 'file4').exists()
+
+        @pytest.mark.datafiles(FIXTURE_DIR / 'dir1')
+        def test_7(datafiles):
+            assert (datafiles / 'file1').exists()
+    """,
+    )
+    result = testdir.runpytest(
+        "-s", "-p", "no:randomly", "--datafiles-group", "--datafiles-prefetch"
+    )
+    result.assert_outcomes(passed=7)
+    # tests are not moved out of their module or class
+    result.stdout.fnmatch_lines(
+        [
+            "*REUSED test_a.py::test_1 None",
+            "*REUSED test_a.py::test_3 True",
+            "*REUSED test_a.py::test_2 None",
+            "*REUSED test_b.py::test_4 None",
+            "*REUSED test_b.py::test_7 True",
+            "*REUSED test_b.py::test_5 None",
+            "*REUSED test_b.py::TestClass::test_6 True",
+        ]
+    )
+    assert result.stdout.str().count("SETUP test_b") == 1
+
+
+def test_xdist_shared_snapshots(testdir, tmp_path):
+    """
+    Verify pytest-xdist workers share the snapshots of the session cache and
+    the output of generated entries and the controller removes them at the
+    end.
+    """
+    pytest.importorskip("xdist")
+    log = tmp_path / "calls"
+    testdir.makepyfile(f"""
+        import os
+        import pytest
+        from pathlib import Path
+        from pytest_datafiles import generated
+
+        FIXTURE_DIR = Path('{FIXTURE_DIR}')
+
+        def make_file(directory):
+            with open('{log}', 'a') as log:
+                log.write('generated\\n')
+            (directory / 'file').write_text('content')
+
+        @pytest.mark.parametrize('number', range(8))
+        @pytest.mark.datafiles(generated('data', make_file))
+        def test_generated(datafiles, number):
+            assert (datafiles / 'file').read_text() == 'content'
+
+        @pytest.mark.parametrize('number', range(8))
+        @pytest.mark.datafiles(FIXTURE_DIR / 'dir4')
+        def test_shared(datafiles, tmp_path_factory, number):
+            root = tmp_path_factory.getbasetemp().parent / 'datafiles-cache'
+            snapshots = [
+                name for name in os.listdir(root)
+                if not name.endswith('.lock') and not name.startswith('.')
+            ]
+            assert len(snapshots) == 1
+            source = datafiles.plan.files[str(datafiles / 'subdir1' / 'file1')].source
+            assert source.startswith(str(root / snapshots[0]))
+            assert (datafiles / 'subdir1' / 'file1').read_text() == (
+                FIXTURE_DIR / 'dir4' / 'subdir1' / 'file1'
+            ).read_text()
+    """)
+    basetemp = tmp_path / "basetemp"
+    result = testdir.runpytest_subprocess(
+        "-n", "2", f"--basetemp={basetemp}", "--datafiles-cache-size=1M"
+    )
+    result.assert_outcomes(passed=16)
+    assert sorted(p.name for p in basetemp.iterdir()) == ["popen-gw0", "popen-gw1"]
+    assert log.read_text() == "generated\n"
+
+
+def test_ram_location(testdir, tmp_path, monkeypatch):
+    """
+    Verify location='ram' copies to a directory in RAM that is removed after
+    the test, unless the files don't fit into the budget.
+    """
+    ram = tmp_path / "ram"
+    ram.mkdir()
+    monkeypatch.setattr(pytest_datafiles, "_RAM_DIR", str(ram))
+    testdir.makeconftest("""
+        def pytest_runtest_logreport(report):
+            if report.when == 'teardown':
+                for stats in report.datafiles:
+                    print('LOCATION', report.nodeid, stats.get('location'))
+    """)
+    testdir.makepyfile(f"""
+        import pytest
+        from pathlib import Path
+
+        FIXTURE_DIR = Path('{FIXTURE_DIR}')
+        RAM = Path('{ram}')
+        used = []
+
+        @pytest.mark.datafiles(FIXTURE_DIR / 'random.bin', location='ram')
+        def test_ram(datafiles, tmp_path):
+            assert datafiles != tmp_path
+            assert datafiles.parent.parent == RAM
+            assert (datafiles / 'random.bin').stat().st_size == 5120
+            used.append(datafiles)
+
+        @pytest.mark.datafiles(FIXTURE_DIR / 'dir1', location='ram')
+        def test_too_big(datafiles, tmp_path):
+            assert not used[0].exists()
+            assert datafiles == tmp_path
+            assert (datafiles / 'file1').exists()
+
+        @pytest.mark.datafiles(FIXTURE_DIR / 'huckleberry.txt')
+        def test_default(datafiles):
+            assert (datafiles / 'huckleberry.txt').exists()
+    """)
+    result = testdir.runpytest(
+        "-s", "-p", "no:randomly", "--datafiles-ram-size=8K", "-k", "not default"
+    )
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines(
+        [
+            "*LOCATION test_ram_location.py::test_ram ram",
+            "*LOCATION test_ram_location.py::test_too_big tmp",
+        ]
+    )
+    assert list(ram.iterdir()) == []
+
+    result = testdir.runpytest("-s", "--datafiles-basetemp-ram", "-k", "default")
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines(["*LOCATION test_ram_location.py::test_default ram"])
+    assert list(ram.iterdir()) == []
+
+
+def test_ram_location_xdist(testdir, tmp_path):
+    """
+    Verify the RAM budget is shared by the pytest-xdist workers.
+    """
+    pytest.importorskip("xdist")
+    ram = tmp_path / "ram"
+    ram.mkdir()
+    testdir.makeconftest(f"""
+        import pytest_datafiles
+
+        pytest_datafiles._RAM_DIR = {str(ram)!r}
+    """)
+    testdir.makepyfile(f"""
+        import time
+        import pytest
+        from pathlib import Path
+
+        BARRIER = Path({str(tmp_path / "barrier")!r})
+
+        @pytest.mark.parametrize('worker', [0, 1])
+        @pytest.mark.datafiles('{FIXTURE_DIR / "random.bin"}', location='ram')
+        def test_ram(datafiles, tmp_path, worker):
+            # wait until both workers set up their datafiles
+            (BARRIER / str(worker)).mkdir(parents=True)
+            deadline = time.monotonic() + 30
+            while len(list(BARRIER.iterdir())) < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            location = 'tmp' if datafiles == tmp_path else 'ram'
+            (BARRIER / str(worker) / location).touch()
+    """)
+    result = testdir.runpytest("-n", "2", "--datafiles-ram-size=8K")
+    result.assert_outcomes(passed=2)
+    # only one of the files fits into the budget at the same time
+    locations = [path.name for path in (tmp_path / "barrier").glob("*/*")]
+    assert sorted(locations) == ["ram", "tmp"]
+
+
+@pytest.mark.parametrize("retain", ["all", "failed", "none"])
+def test_retain(testdir, tmp_path, retain):
+    """
+    Verify the datafiles of the tests are removed after the test according to
+    --datafiles-retain, including read-only directories, but not other files
+    in tmp_path.
+    """
+    source = tmp_path / "source"
+    (source / "readonly").mkdir(parents=True)
+    (source / "readonly" / "file").write_text("content")
+    (source / "top").write_text("content")
+    (source / "readonly").chmod(0o555)
+    testdir.makepyfile(f"""
+        import pytest
+
+        @pytest.mark.datafiles('{source}')
+        @pytest.mark.parametrize('outcome', ['passed', 'failed'])
+        def test_retain(datafiles, tmp_path, outcome):
+            (tmp_path / 'own').write_text('content')
+            with open('{tmp_path}/' + outcome, 'w') as log:
+                log.write(str(tmp_path))
+            assert outcome == 'passed'
+    """)
+    result = testdir.runpytest(f"--datafiles-retain={retain}")
+    result.assert_outcomes(passed=1, failed=1)
+    kept = {"all": ["passed", "failed"], "failed": ["failed"], "none": []}[retain]
+    for outcome in ["passed", "failed"]:
+        test_tmp_path = Path((tmp_path / outcome).read_text())
+        expected = ["own", "readonly", "top"] if outcome in kept else ["own"]
+        assert sorted(os.listdir(test_tmp_path)) == expected
+    (source / "readonly").chmod(0o755)
+
+
+def test_marks_resolved_at_collection(testdir, tmp_path):
+    """
+    Verify the marks are resolved once during collection for all tests with
+    the same marks, that the marked directories are listed for every setup,
+    and that invalid marks are reported before any test runs and only fail
+    the setup of the affected tests (unless they are skipped).
+    """
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "file1").write_text("content")
+    testdir.makepyfile(f"""
+        import pytest
+        from pathlib import Path
+
+        pytestmark = pytest.mark.datafiles('{source}')
+
+        @pytest.fixture(scope='session', autouse=True)
+        def add_file():
+            (Path('{source}') / 'file2').write_text('added after collection')
+
+        def marks(request, name):
+            state = request.config.pluginmanager.get_plugin('datafiles_state')
+            return state.marks[request.node.nodeid.replace('test_1', name)]
+
+        def test_1(request, datafiles):
+            assert marks(request, 'test_1') is marks(request, 'test_2')
+
+        def test_2(datafiles):
+            assert sorted(p.name for p in datafiles.iterdir()) == ['file1', 'file2']
+    """)
+    testdir.runpytest().assert_outcomes(passed=2)
+
+    testdir.makepyfile(
+        test_invalid=f"""
+        import os
+        import pytest
+        from pathlib import Path
+
+        FIXTURE_DIR = Path('{FIXTURE_DIR}')
+
+        @pytest.mark.datafiles(FIXTURE_DIR / 'fileZZ')
+        def test_missing(datafiles):
+            pass
+
+        @pytest.mark.datafiles(FIXTURE_DIR / 'dir1', lazy='yes')
+        def test_invalid(datafiles):
+            pass
+
+        @pytest.mark.skipif(
+            not os.path.exists(FIXTURE_DIR / 'fileZZ'), reason='no file'
+        )
+        @pytest.mark.datafiles(FIXTURE_DIR / 'fileZZ')
+        def test_skipped(datafiles):
+            pass
+
+        @pytest.mark.datafiles(FIXTURE_DIR / 'fileZZ')
+        def test_without_fixture():
+            pass
+
+        @pytest.mark.datafiles(FIXTURE_DIR / 'dir1')
+        def test_valid(datafiles):
+            pass
+    """
+    )
+    result = testdir.runpytest("test_invalid.py")
+    result.assert_outcomes(passed=2, skipped=1, errors=2)
+    result.stdout.fnmatch_lines(
+        [
+            "Invalid datafiles marks (the setup of these tests fails):",
+            "  test_invalid.py::test_missing: FileNotFoundError:*fileZZ'",
+            "  test_invalid.py::test_invalid: ValueError: 'lazy' must be True or False",
+            "test_invalid.py *",
+        ]
+    )
+    result.stdout.no_fnmatch_line("  test_invalid.py::test_skipped*")
+    result.stdout.no_fnmatch_line("  test_invalid.py::test_without_fixture*")